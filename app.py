@@ -1,13 +1,109 @@
 import argparse
+import array
 import bisect
+import codecs
+import collections
+import concurrent.futures
+import enum
+import fnmatch
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import locale
+import math
+import mmap
+import multiprocessing
+import multiprocessing.connection
 import os
 import re
+import socket
+import stat
+import struct
+import subprocess
 import sys
+import time
 import warnings
 from typing import *
 
 import unicodedata
 
+try:
+    import re2  # optional: `--engine re2`
+except ImportError:
+    re2 = None
+
+
+# ========================================== PROFILING ==========================================
+
+class Profiler:
+    # Per-phase timers, counters and the slowest files of a search (`--profile`). Hot paths check the
+    # module-level `profiler` for None before measuring anything, so a search without profiling pays only
+    # for these checks. `occurrence` time is included in `search` time.
+    phases = ('discover', 'read', 'decode', 'normalize', 'mask', 'scopes', 'search', 'occurrence', 'format',
+              'output')
+    __slots__ = ('times', 'counters', 'top', 'slowest', 'time_start')
+
+    def __init__(self, top: int = 10):
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.counters = collections.Counter()
+        self.top = top
+        self.slowest = []  # min-heap of (seconds, file)
+        self.time_start = time.perf_counter()
+
+    def add(self, phase: str, time_start: float):
+        self.times[phase] += time.perf_counter() - time_start
+
+    def count(self, counter: str, value: int = 1):
+        self.counters[counter] += value
+
+    def file_done(self, file: str, seconds: float):
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, (seconds, file))
+        elif self.slowest and seconds > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, (seconds, file))
+
+    def iterate(self, phase: str, iterable: Iterable[Any]) -> Iterator[Any]:
+        # times the production of every item of `iterable` (e.g. a lazy directory walk)
+        iterator = iter(iterable)
+        while True:
+            time_start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(phase, time_start)
+                return
+            self.add(phase, time_start)
+            yield item
+
+    def report(self, output_format: Literal['table', 'json'] = 'table') -> str:
+        total = time.perf_counter() - self.time_start
+        slowest = sorted(self.slowest, reverse=True)
+        if output_format == 'json':
+            return json.dumps({'total': round(total, 6),
+                               'phases': {phase: round(seconds, 6) for phase, seconds in self.times.items()},
+                               'counters': dict(sorted(self.counters.items())),
+                               'slowest': [{'file': file, 'seconds': round(seconds, 6)}
+                                           for seconds, file in slowest]}) + '\n'
+        lines = [f"{'phase':<20}{'seconds':>10}{'share':>9}"]
+        for phase, seconds in self.times.items():
+            lines.append(f"{phase:<20}{seconds:>10.3f}{100 * seconds / total if total else 0:>8.1f}%")
+        lines.append(f"{'total':<20}{total:>10.3f}")
+        lines.append('')
+        lines.append(f"{'counter':<20}{'value':>10}")
+        for counter, value in sorted(self.counters.items()):
+            lines.append(f"{counter:<20}{value:>10}")
+        if slowest:
+            lines.append('')
+            lines.append(f'slowest {len(slowest)} files:')
+            for seconds, file in slowest:
+                lines.append(f'{seconds:>10.3f}  {file}')
+        return '\n'.join(lines) + '\n'
+
+
+profiler: Optional[Profiler] = None
+
 
 # ========================================== CLASSES WITH METHODS ==========================================
 
@@ -23,32 +119,214 @@ class Occurrence(TypedDict):
     matched_position_in_end_block: int
 
 
-class BaseMethods:
-    @classmethod
-    def determine_occurrence(cls, file_content: str, abs_start: int, abs_end: int):
-        block_index_start = file_content.count('\n', 0, abs_start)
-        block_index_end = file_content.count('\n', 0, abs_end)
+class TokenKind(enum.IntFlag):
+    CODE = 0
+    COMMENT = 1
+    DIRECTIVE = 2
+    CHAR_LITERAL = 4
+    STRING_LITERAL = 8
+    ALL = COMMENT | DIRECTIVE | CHAR_LITERAL | STRING_LITERAL
 
-        abs_start_of_start_block = file_content.rfind('\n', 0, abs_start)
-        abs_start_of_end_block = file_content.rfind('\n', 0, abs_end)
-        abs_end_of_start_block = file_content.find('\n', abs_start, len(file_content))
-        abs_end_of_end_block = file_content.find('\n', abs_end, len(file_content))
 
-        if abs_start_of_start_block == -1:
-            abs_start_of_start_block = 0
-        else:
-            abs_start_of_start_block += 1
+# (start, end, kind) of a non-code part of a file, `kind` is a combination of `TokenKind` flags
+Span = Tuple[int, int, int]
 
-        if abs_start_of_end_block == -1:
-            abs_start_of_end_block = 0
-        else:
-            abs_start_of_end_block += 1
 
-        if abs_end_of_start_block == -1:
-            abs_end_of_start_block = len(file_content)
+class LineIndex:
+    __slots__ = ('line_starts', 'length')
+
+    def __init__(self, file_content: str):
+        line_starts = [0]
+        offset = 0
+        for line in file_content.split('\n')[:-1]:
+            offset += len(line) + 1
+            line_starts.append(offset)
+        self.line_starts = line_starts
+        self.length = len(file_content)
+
+    def line_number(self, abs_pos: int) -> int:
+        return bisect.bisect_right(self.line_starts, abs_pos) - 1
+
+    def line_start(self, line_number: int) -> int:
+        return self.line_starts[line_number]
+
+    def line_end(self, line_number: int) -> int:
+        if line_number + 1 < len(self.line_starts):
+            return self.line_starts[line_number + 1] - 1
+        return self.length
+
+
+class ScopeStack:
+    # Scopes (`nesteds_start`/`nesteds_end`, sorted by start) that contain a position, for positions given in
+    # ascending order: scopes are pushed when the position passes their start and dropped once it passes their
+    # end, so every scope is visited once for all positions plus once per position it contains.
+    __slots__ = ('nesteds_start', 'nesteds_end', 'active', 'alive', 'dead', 'ends_heap', 'next_scope')
+
+    def __init__(self, nesteds_start: List[int], nesteds_end: List[int]):
+        self.nesteds_start = nesteds_start
+        self.nesteds_end = nesteds_end
+        self.active = []
+        self.alive = [True] * len(nesteds_start)
+        self.dead = 0
+        self.ends_heap = []
+        self.next_scope = 0
+
+    def enclosing(self, position: int) -> List[int]:
+        # indices of the scopes with `start <= position <= end`, innermost (latest start) first
+        nesteds_start = self.nesteds_start
+        nesteds_end = self.nesteds_end
+        active = self.active
+        alive = self.alive
+        ends_heap = self.ends_heap
+        while self.next_scope < len(nesteds_start) and nesteds_start[self.next_scope] <= position:
+            active.append(self.next_scope)
+            heapq.heappush(ends_heap, (nesteds_end[self.next_scope], self.next_scope))
+            self.next_scope += 1
+        while ends_heap and ends_heap[0][0] < position:
+            alive[heapq.heappop(ends_heap)[1]] = False
+            self.dead += 1
+        while active and not alive[active[-1]]:
+            active.pop()
+            self.dead -= 1
+        if self.dead > len(active) // 2:
+            active[:] = [i for i in active if alive[i]]
+            self.dead = 0
+        return [i for i in reversed(active) if alive[i]]
+
+
+class ScopeTracker:
+    # Forward counterpart of `CppBaseMethods.determine_scopes` for content seen piece by piece: headers and
+    # brackets of the clean content are fed in order, a header ends at the first `}` or `;` that brings the
+    # depths back to the ones at the header and is discarded at the first bracket that drops a depth below
+    # them. A header is a list `[start, line, text, end, end line]`, `end` is -1 while pending and None once
+    # discarded.
+    __slots__ = ('levels', 'pending')
+
+    def __init__(self):
+        self.levels = (0, 0, 0)
+        self.pending = {}  # depths -> headers waiting for their end
+
+    def header(self, header: list):
+        self.pending.setdefault(self.levels, []).append(header)
+
+    def bracket(self, position: int, ch: str) -> List[list]:
+        # returns the headers ended by the bracket at `position`
+        curly_braces, round_brackets, square_brackets = self.levels
+        if ch == '{':
+            curly_braces += 1
+        elif ch == '}':
+            curly_braces -= 1
+        elif ch == '(':
+            round_brackets += 1
+        elif ch == ')':
+            round_brackets -= 1
+        elif ch == '[':
+            square_brackets += 1
+        elif ch == ']':
+            square_brackets -= 1
+        levels = self.levels = (curly_braces, round_brackets, square_brackets)
+        ended = []
+        if ch == '}' or ch == ';':
+            ended = self.pending.pop(levels, ended)
+            for header in ended:
+                header[3] = position + 1
+        if ch == '}':
+            self.discard(0, curly_braces + 1)
+        elif ch == ')':
+            self.discard(1, round_brackets + 1)
+        elif ch == ']':
+            self.discard(2, square_brackets + 1)
+        return ended
+
+    def discard(self, depth_index: int, depth: int):
+        for levels in [levels for levels in self.pending if levels[depth_index] == depth]:
+            for header in self.pending.pop(levels):
+                header[3] = None
+
+    def finish(self, end: int) -> List[list]:
+        # headers never ended nor discarded last until the end of the content
+        ended = [header for headers in self.pending.values() for header in headers]
+        for header in ended:
+            header[3] = end
+        self.pending.clear()
+        return ended
+
+
+class Scope:
+    # a flow control scope enclosing a match; lines are 1-based, the header line is sliced on demand
+    __slots__ = ('start', 'end', 'line_start', 'line_end', '_file_content', '_line_index')
+
+    def __init__(self, start: int, end: int, file_content: str, line_index: LineIndex):
+        self.start = start
+        self.end = end
+        self.line_start = 1 + line_index.line_number(start)
+        self.line_end = 1 + line_index.line_number(end)
+        self._file_content = file_content
+        self._line_index = line_index
+
+    @property
+    def header(self) -> str:
+        line_number = self.line_start - 1
+        return self._file_content[self._line_index.line_start(line_number):self._line_index.line_end(line_number)]
+
+    def __repr__(self):
+        return f'Scope(start={self.start}, end={self.end}, line_start={self.line_start}, line_end={self.line_end})'
+
+
+class Match:
+    # A match of the searched regex: offsets into the file content, 1-based lines and columns (as printed by
+    # the CLI), the enclosing scopes, outermost first (empty in simple mode), and the ID of the matched pattern
+    # when several patterns are searched. The matched text and its lines are sliced on demand.
+    __slots__ = ('file', 'start', 'end', 'line_start', 'column_start', 'line_end', 'column_end', 'scopes',
+                 'pattern', '_file_content', '_line_index')
+
+    def __init__(self, file: Optional[str], start: int, end: int, scopes: Tuple[Scope, ...],
+                 file_content: str, line_index: LineIndex, pattern: Optional[str] = None):
+        self.file = file
+        self.start = start
+        self.end = end
+        line_start = line_index.line_number(start)
+        line_end = line_index.line_number(end)
+        self.line_start = 1 + line_start
+        self.column_start = 1 + start - line_index.line_start(line_start)
+        self.line_end = 1 + line_end
+        self.column_end = 1 + end - line_index.line_start(line_end)
+        self.scopes = scopes
+        self.pattern = pattern
+        self._file_content = file_content
+        self._line_index = line_index
+
+    @property
+    def text(self) -> str:
+        return self._file_content[self.start:self.end]
+
+    @property
+    def lines(self) -> str:
+        # the whole lines of the match, as shown under the location by the CLI (before whitespace folding)
+        return self._file_content[self._line_index.line_start(self.line_start - 1):
+                                  self._line_index.line_end(self.line_end - 1)]
+
+    def __repr__(self):
+        return (f'Match(file={self.file!r}, start={self.start}, end={self.end}, '
+                f'line_start={self.line_start}, column_start={self.column_start}, '
+                f'line_end={self.line_end}, column_end={self.column_end}, scopes={self.scopes!r}' +
+                (f', pattern={self.pattern!r})' if self.pattern is not None else ')'))
+
+
+class BaseMethods:
+    @classmethod
+    def determine_occurrence(cls, file_content: str, abs_start: int, abs_end: int,
+                             line_index: LineIndex = None):
+        if line_index is None:
+            line_index = LineIndex(file_content)
+
+        block_index_start = line_index.line_number(abs_start)
+        block_index_end = line_index.line_number(abs_end)
 
-        if abs_end_of_end_block == -1:
-            abs_end_of_end_block = len(file_content)
+        abs_start_of_start_block = line_index.line_start(block_index_start)
+        abs_start_of_end_block = line_index.line_start(block_index_end)
+        abs_end_of_start_block = line_index.line_end(block_index_start)
+        abs_end_of_end_block = line_index.line_end(block_index_end)
 
         matched_position_in_start_block = abs_start - abs_start_of_start_block
         matched_position_in_end_block = abs_end - abs_start_of_end_block
@@ -61,19 +339,41 @@ class BaseMethods:
                           matched_position_in_start_block=matched_position_in_start_block,
                           matched_position_in_end_block=matched_position_in_end_block)
 
+    @classmethod
+    def blank(cls, text: str) -> str:
+        return '\n'.join(' ' * len(line) for line in text.split('\n'))
+
     @classmethod
     def replace_with_spaces(cls, file_content: str, regex: re.Pattern):
+        pieces = []
+        pos = 0
         for match in regex.finditer(file_content):
             start, end = match.span(0)
-            mid_string = ''
-            for line in match.group(0).splitlines(True):
-                end = start + len(line)
-                b = (line[-1] == '\n')
-                mid_string += ' ' * (end - start - b) + '\n' * b
-                start = end + 1
-            start, end = match.span(0)
-            file_content = file_content[:start] + mid_string + file_content[end:]
-        return file_content
+            if start == end:
+                continue
+            pieces.append(file_content[pos:start])
+            pieces.append(cls.blank(match.group(0)))
+            pos = end
+        if not pieces:
+            return file_content
+        pieces.append(file_content[pos:])
+        return ''.join(pieces)
+
+    @classmethod
+    def mask(cls, file_content: str, spans: List[Span], kinds: int) -> str:
+        if not kinds:
+            return file_content
+        pieces = []
+        pos = 0
+        for start, end, kind in spans:
+            if kind & kinds:
+                pieces.append(file_content[pos:start])
+                pieces.append(cls.blank(file_content[start:end]))
+                pos = end
+        if not pieces:
+            return file_content
+        pieces.append(file_content[pos:])
+        return ''.join(pieces)
 
 
 class CppBaseMethods(BaseMethods):
@@ -90,6 +390,122 @@ class CppBaseMethods(BaseMethods):
                                                      char_literal_regex.pattern,
                                                      string_literal_regex.pattern]), re.DOTALL)
 
+    bracket_regex = re.compile(r'[{}()\[\];]')
+    token_regex = re.compile(r'/[/*]|["\']|^[^\S\n]*#', re.MULTILINE)
+    directive_token_regex = re.compile(r'/[/*]|["\']|\n')
+    string_body_regex = re.compile(r'[^"\\\n]*(?:\\.[^"\\\n]*)*', re.DOTALL)
+    char_body_regex = re.compile(r"[^'\\\n]*(?:\\.[^'\\\n]*)*", re.DOTALL)
+    raw_string_delimiter_regex = re.compile(r'[^()\\\s]{0,16}\(')
+    raw_string_prefixes = frozenset({'R', 'LR', 'uR', 'UR', 'u8R'})
+
+    @classmethod
+    def skip_kinds(cls, comments: bool = False, directives: bool = False,
+                   char_str_literals: bool = False) -> int:
+        kinds = TokenKind.CODE
+        if comments:
+            kinds |= TokenKind.COMMENT
+        if directives:
+            kinds |= TokenKind.DIRECTIVE
+        if char_str_literals:
+            kinds |= TokenKind.CHAR_LITERAL | TokenKind.STRING_LITERAL
+        return int(kinds)
+
+    @classmethod
+    def _line_end(cls, file_content: str, pos: int) -> int:
+        # end of a logical line: a backslash before the newline splices the next line
+        while True:
+            end = file_content.find('\n', pos)
+            if end == -1:
+                return len(file_content)
+            if file_content.endswith('\\', 0, end) or file_content.endswith('\\\r', 0, end):
+                pos = end + 1
+                continue
+            return end
+
+    @classmethod
+    def _identifier_before(cls, file_content: str, pos: int) -> str:
+        start = pos
+        while start > 0 and (file_content[start - 1].isalnum() or file_content[start - 1] in "_'"):
+            start -= 1
+        return file_content[start:pos]
+
+    @classmethod
+    def _lex_token(cls, file_content: str, start: int, token: str) -> Tuple[int, int]:
+        if token == '//':
+            return cls._line_end(file_content, start), TokenKind.COMMENT
+        if token == '/*':
+            end = file_content.find('*/', start + 2)
+            return (len(file_content) if end == -1 else end + 2), TokenKind.COMMENT
+        if token == '"':
+            prefix = cls._identifier_before(file_content, start)
+            if prefix in cls.raw_string_prefixes:
+                match = cls.raw_string_delimiter_regex.match(file_content, start + 1)
+                if match:
+                    closing = ')' + match.group(0)[:-1] + '"'
+                    end = file_content.find(closing, match.end())
+                    return (len(file_content) if end == -1 else end + len(closing)), TokenKind.STRING_LITERAL
+            end = cls.string_body_regex.match(file_content, start + 1).end()
+            return (end + 1 if file_content.startswith('"', end) else end), TokenKind.STRING_LITERAL
+        # token == "'"
+        prefix = cls._identifier_before(file_content, start)
+        if prefix[:1].isdigit():
+            # digit separator, e.g. `1'000'000`
+            return start + 1, TokenKind.CODE
+        end = cls.char_body_regex.match(file_content, start + 1).end()
+        return (end + 1 if file_content.startswith("'", end) else end), TokenKind.CHAR_LITERAL
+
+    @classmethod
+    def _lex_directive(cls, file_content: str, start: int, spans: List[Span]) -> int:
+        pos = start
+        while True:
+            match = cls.directive_token_regex.search(file_content, pos)
+            if match is None:
+                end = len(file_content)
+                break
+            token = match.group(0)
+            token_start = match.start()
+            if token == '\n':
+                if file_content.endswith('\\', 0, token_start) or file_content.endswith('\\\r', 0, token_start):
+                    pos = token_start + 1
+                    continue
+                end = token_start
+                break
+            token_end, kind = cls._lex_token(file_content, token_start, token)
+            if kind:
+                if start < token_start:
+                    spans.append((start, token_start, int(TokenKind.DIRECTIVE)))
+                spans.append((token_start, token_end, int(TokenKind.DIRECTIVE | kind)))
+                start = token_end
+            pos = token_end
+            if token == '//':
+                end = token_end
+                break
+        if start < end:
+            spans.append((start, end, int(TokenKind.DIRECTIVE)))
+        return end
+
+    @classmethod
+    def tokenize(cls, file_content: str) -> List[Span]:
+        # one pass over the file: sorted, non-overlapping spans of comments, directives and literals
+        # (raw strings too), the gaps between them are code; comments and literals inside a directive
+        # are separate spans with both flags set
+        spans = []
+        pos = 0
+        token_regex = cls.token_regex
+        while True:
+            match = token_regex.search(file_content, pos)
+            if match is None:
+                break
+            token = match.group(0)
+            if token[-1] == '#':
+                pos = cls._lex_directive(file_content, match.end() - 1, spans)
+                continue
+            start = match.start()
+            pos, kind = cls._lex_token(file_content, start, token)
+            if kind:
+                spans.append((start, pos, int(kind)))
+        return spans
+
     @classmethod
     def generate_regex_for_single_line_skip(cls, single_line_comments: bool = False):
         one_line_regex_list = []
@@ -114,138 +530,1924 @@ class CppBaseMethods(BaseMethods):
         return re.compile('|'.join(multi_line_regex_list), flags=re.DOTALL)
 
     @classmethod
-    def simple_mode_search(cls, regex: re.Pattern, file_content: str,
+    def determine_scopes(cls, clean_file_content: str) -> Tuple[List[int], List[int]]:
+        # A flow control header ends at the first `}` or `;` after it where the curly, round and square
+        # bracket depths are back to the depths at the header, or is discarded if any depth drops below
+        # them first. Scanning the brackets once from the end of the file and remembering where each depth
+        # was last reached resolves every header without rescanning its block.
+        starts = [match.start() for match in cls.flow_control_regex.finditer(clean_file_content)]
+        if not starts:
+            return [], []
+        events = [(match.start(), match.group(0)) for match in cls.bracket_regex.finditer(clean_file_content)]
+        levels = []
+        curly_braces = round_brackets = square_brackets = 0
+        for _, ch in events:
+            if ch == '{':
+                curly_braces += 1
+            elif ch == '}':
+                curly_braces -= 1
+            elif ch == '(':
+                round_brackets += 1
+            elif ch == ')':
+                round_brackets -= 1
+            elif ch == '[':
+                square_brackets += 1
+            elif ch == ']':
+                square_brackets -= 1
+            levels.append((curly_braces, round_brackets, square_brackets))
+
+        no_position = len(clean_file_content) + 1
+        ends = []
+        block_end_at = {}
+        curly_drop_at = {}
+        round_drop_at = {}
+        square_drop_at = {}
+        e = len(events) - 1
+        for start in reversed(starts):
+            while e >= 0 and events[e][0] >= start:
+                pos, ch = events[e]
+                level = levels[e]
+                if ch == '}':
+                    block_end_at[level] = pos + 1
+                    curly_drop_at[level[0]] = pos + 1
+                elif ch == ';':
+                    block_end_at[level] = pos + 1
+                elif ch == ')':
+                    round_drop_at[level[1]] = pos + 1
+                elif ch == ']':
+                    square_drop_at[level[2]] = pos + 1
+                e -= 1
+            curly_braces, round_brackets, square_brackets = levels[e] if e >= 0 else (0, 0, 0)
+            end = block_end_at.get((curly_braces, round_brackets, square_brackets), no_position)
+            error = min(curly_drop_at.get(curly_braces - 1, no_position),
+                        round_drop_at.get(round_brackets - 1, no_position),
+                        square_drop_at.get(square_brackets - 1, no_position))
+            if end < error:
+                ends.append(end)
+            elif error < no_position:
+                ends.append(None)
+            else:
+                ends.append(len(clean_file_content))
+        ends.reverse()
+
+        nesteds_start = []
+        nesteds_end = []
+        for start, end in zip(starts, ends):
+            if end is not None:
+                nesteds_start.append(start)
+                nesteds_end.append(end)
+        return nesteds_start, nesteds_end
+
+    @classmethod
+    def trace_location(cls, occ: Occurrence, line_offset: int = 0) -> str:
+        # location of a match in a nesting trace, `line_offset` is added to the lines of `occ`
+        block_index_start = line_offset + occ['block_index_start']
+        block_index_end = line_offset + occ['block_index_end']
+        matched_position_in_start_block = occ['matched_position_in_start_block']
+        matched_position_in_end_block = occ['matched_position_in_end_block']
+        if (block_index_start == block_index_end and
+                matched_position_in_start_block == matched_position_in_end_block):
+            return f"{1 + block_index_start}:{1 + matched_position_in_start_block}"
+        elif block_index_start == block_index_end:
+            return f"{1 + block_index_start}:{1 + matched_position_in_start_block}-{1 + matched_position_in_end_block}"
+        return (f"{1 + block_index_start}:{1 + matched_position_in_start_block}-"
+                f"{1 + block_index_end}:{1 + matched_position_in_end_block}")
+
+    @classmethod
+    def intersects(cls, changed_lines: Sequence[Tuple[int, int]], first_line: int, last_line: int) -> bool:
+        # whether lines `first_line`..`last_line` (0-based) meet one of the sorted, disjoint, inclusive ranges
+        i = bisect.bisect_right(changed_lines, (last_line, math.inf)) - 1
+        return i >= 0 and changed_lines[i][1] >= first_line
+
+    @classmethod
+    def simple_mode_search(cls, regex: Union[re.Pattern, 'PatternSet'], file_content: str,
                            regex_for_single_line_skip: re.Pattern = None,
-                           regex_for_multi_line_skip: re.Pattern = None) -> List[Tuple[str, str]]:
+                           regex_for_multi_line_skip: re.Pattern = None,
+                           skip_kinds: int = None,
+                           spans: List[Span] = None,
+                           changed_lines: Sequence[Tuple[int, int]] = None) -> List[Tuple[str, str]]:
         original_file_content = file_content
-        if isinstance(regex_for_single_line_skip, re.Pattern):
-            file_content = CppBaseMethods.replace_with_spaces(file_content,
-                                                              regex_for_single_line_skip)
-        if isinstance(regex_for_multi_line_skip, re.Pattern):
-            file_content = CppBaseMethods.replace_with_spaces(file_content,
-                                                              regex_for_multi_line_skip)
+        if profiler is not None:
+            time_start = time.perf_counter()
+        if skip_kinds is not None:
+            if skip_kinds:
+                if spans is None:
+                    spans = cls.tokenize(file_content)
+                file_content = cls.mask(file_content, spans, skip_kinds)
+        else:
+            if isinstance(regex_for_single_line_skip, re.Pattern):
+                file_content = CppBaseMethods.replace_with_spaces(file_content,
+                                                                  regex_for_single_line_skip)
+            if isinstance(regex_for_multi_line_skip, re.Pattern):
+                file_content = CppBaseMethods.replace_with_spaces(file_content,
+                                                                  regex_for_multi_line_skip)
+        if profiler is not None:
+            profiler.add('mask', time_start)
+            profiler.count('chars_scanned', len(file_content))
+            time_start = time.perf_counter()
 
+        line_index = LineIndex(file_content)
         result = []
         for match in regex.finditer(file_content):
             abs_start, abs_end = match.span(0)
-            occ = cls.determine_occurrence(file_content, abs_start, abs_end)
+            if changed_lines is not None and not cls.intersects(changed_lines, line_index.line_number(abs_start),
+                                                                line_index.line_number(abs_end)):
+                continue
+            if profiler is not None:
+                occurrence_time_start = time.perf_counter()
+            occ = cls.determine_occurrence(file_content, abs_start, abs_end, line_index)
+            if profiler is not None:
+                profiler.add('occurrence', occurrence_time_start)
             format_string = f"{1 + occ['block_index_start']}:{1 + occ['matched_position_in_start_block']}-"
             format_string += f"{1 + occ['block_index_end']}:{1 + occ['matched_position_in_end_block']}"
+            if isinstance(regex, PatternSet):
+                format_string += f" [{regex.tag(match)}]"
             start = occ['abs_start_of_start_block']
             end = occ['abs_end_of_end_block']
             result.append((original_file_content[start:end], format_string))
+        if profiler is not None:
+            profiler.add('search', time_start)
+            profiler.count('matches', len(result))
         return result
 
     @classmethod
-    def nesting_mode_search(cls, regex: re.Pattern, file_content: str,
+    def nesting_mode_search(cls, regex: Union[re.Pattern, 'PatternSet'], file_content: str,
                             regex_for_single_line_skip: re.Pattern = None,
-                            regex_for_multi_line_skip: re.Pattern = None) -> List[List[Tuple[str, str]]]:
+                            regex_for_multi_line_skip: re.Pattern = None,
+                            skip_kinds: int = None,
+                            spans: List[Span] = None,
+                            scopes: Tuple[List[int], List[int]] = None,
+                            changed_lines: Sequence[Tuple[int, int]] = None) -> List[List[Tuple[str, str]]]:
         original_file_content = file_content
+        if profiler is not None:
+            time_start = time.perf_counter()
 
-        clean_file_content = CppBaseMethods.replace_with_spaces(file_content,
-                                                                cls.regex_for_single_line_skip)
-        clean_file_content = CppBaseMethods.replace_with_spaces(clean_file_content,
-                                                                cls.regex_for_multi_line_skip)
+        clean_file_content = None
+        if skip_kinds is not None:
+            if spans is None:
+                spans = cls.tokenize(file_content)
+            if scopes is None:
+                clean_file_content = cls.mask(file_content, spans, int(TokenKind.ALL))
+            if skip_kinds == TokenKind.ALL and clean_file_content is not None:
+                file_content = clean_file_content
+            else:
+                file_content = cls.mask(file_content, spans, skip_kinds)
+        else:
+            if scopes is None:
+                clean_file_content = CppBaseMethods.replace_with_spaces(file_content,
+                                                                        cls.regex_for_single_line_skip)
+                clean_file_content = CppBaseMethods.replace_with_spaces(clean_file_content,
+                                                                        cls.regex_for_multi_line_skip)
 
-        if isinstance(regex_for_single_line_skip, re.Pattern):
-            file_content = CppBaseMethods.replace_with_spaces(file_content,
-                                                              regex_for_single_line_skip)
-        if isinstance(regex_for_multi_line_skip, re.Pattern):
-            file_content = CppBaseMethods.replace_with_spaces(file_content,
-                                                              regex_for_multi_line_skip)
+            if isinstance(regex_for_single_line_skip, re.Pattern):
+                file_content = CppBaseMethods.replace_with_spaces(file_content,
+                                                                  regex_for_single_line_skip)
+            if isinstance(regex_for_multi_line_skip, re.Pattern):
+                file_content = CppBaseMethods.replace_with_spaces(file_content,
+                                                                  regex_for_multi_line_skip)
 
-        nesteds_start = []
-        nesteds_end = []
-        for match in cls.flow_control_regex.finditer(clean_file_content):
-            start, end = match.span(0)
-            round_brackets = 0
-            square_brackets = 0
-            curly_braces = 0
-            error = False
-            for pos, ch in enumerate(clean_file_content[start:], start):
-                if ch == '{':
-                    curly_braces += 1
-                elif ch == '}':
-                    curly_braces -= 1
-                    if curly_braces == round_brackets == square_brackets == 0:
-                        end = pos + 1
-                        break
-                    elif curly_braces < 0:
-                        error = True
-                        break
-                elif ch == '(':
-                    round_brackets += 1
-                elif ch == ')':
-                    round_brackets -= 1
-                    if round_brackets < 0:
-                        error = True
-                        break
-                elif ch == '[':
-                    square_brackets += 1
-                elif ch == ']':
-                    square_brackets -= 1
-                    if square_brackets < 0:
-                        error = True
-                        break
-                elif ch == ';' and curly_braces == round_brackets == square_brackets == 0:
-                    end = pos + 1
-                    break
-            else:
-                end = len(clean_file_content)
-            if not error:
-                nesteds_start.append(start)
-                nesteds_end.append(end)
+        if profiler is not None:
+            profiler.add('mask', time_start)
+            time_start = time.perf_counter()
+        if scopes is None:
+            scopes = cls.determine_scopes(clean_file_content)
+        nesteds_start, nesteds_end = scopes
+        if profiler is not None:
+            profiler.add('scopes', time_start)
+            profiler.count('chars_scanned', len(file_content))
+            profiler.count('scopes', len(nesteds_start))
+            time_start = time.perf_counter()
 
+        line_index = LineIndex(file_content)
+        scope_entries = {}
+        scope_stack = ScopeStack(nesteds_start, nesteds_end)
         traces = []
         for match in regex.finditer(file_content):
             abs_start, abs_end = match.span(0)
+            if changed_lines is not None and not cls.intersects(changed_lines, line_index.line_number(abs_start),
+                                                                line_index.line_number(abs_end)):
+                continue
             trace = []
 
-            occ = cls.determine_occurrence(file_content, abs_start, abs_end)
-            block_index_start = occ['block_index_start']
-            block_index_end = occ['block_index_end']
-            matched_position_in_start_block = occ['matched_position_in_start_block']
-            matched_position_in_end_block = occ['matched_position_in_end_block']
-            if (block_index_start == block_index_end and
-                    matched_position_in_start_block == matched_position_in_end_block):
-                format_string = f"{1 + block_index_start}:{1 + matched_position_in_start_block}"
-            elif block_index_start == block_index_end:
-                format_string = f"{1 + block_index_start}:{1 + matched_position_in_start_block}-"
-                format_string += f"{1 + matched_position_in_end_block}"
-            else:
-                format_string = f"{1 + block_index_start}:{1 + matched_position_in_start_block}-"
-                format_string += f"{1 + block_index_end}:{1 + matched_position_in_end_block}"
+            if profiler is not None:
+                occurrence_time_start = time.perf_counter()
+            occ = cls.determine_occurrence(file_content, abs_start, abs_end, line_index)
+            if profiler is not None:
+                profiler.add('occurrence', occurrence_time_start)
+            format_string = cls.trace_location(occ)
+            if isinstance(regex, PatternSet):
+                format_string += f" [{regex.tag(match)}]"
             start = occ['abs_start_of_start_block']
             end = occ['abs_end_of_end_block']
             trace.append((original_file_content[start:end], format_string))
-            occ_block_index_start = block_index_start
 
-            i = bisect.bisect_right(nesteds_start, abs_start) - 1
-            last_block_index_start = occ_block_index_start
-            while i >= 0:
-                if nesteds_start[i] <= abs_start <= nesteds_end[i]:
+            last_block_index_start = occ['block_index_start']
+            enclosing = scope_stack.enclosing(abs_start)
+            if profiler is not None:
+                profiler.count('scope_candidates', len(enclosing))
+            for i in enclosing:
+                entry = scope_entries.get(i)
+                if entry is None:
                     start = nesteds_start[i]
                     end = nesteds_end[i]
-                    occ = cls.determine_occurrence(file_content, start, end)
+                    occ = cls.determine_occurrence(file_content, start, end, line_index)
                     block_index_start = occ['block_index_start']
                     block_index_end = occ['block_index_end']
-                    if block_index_start == last_block_index_start:
-                        i -= 1
-                        continue
                     if block_index_start != block_index_end:
                         format_string = f"{1 + block_index_start}-{1 + block_index_end}"
                     else:
                         format_string = f"{1 + block_index_start}"
                     start = occ['abs_start_of_start_block']
                     end = occ['abs_end_of_start_block']
-                    trace.append((original_file_content[start:end], format_string))
-                    last_block_index_start = block_index_start
-                i -= 1
+                    entry = scope_entries[i] = (block_index_start,
+                                                (original_file_content[start:end], format_string))
+                if entry[0] == last_block_index_start:
+                    continue
+                trace.append(entry[1])
+                last_block_index_start = entry[0]
             trace = trace[::-1]
 
             traces.append(trace)
+        if profiler is not None:
+            profiler.add('search', time_start)
+            profiler.count('matches', len(traces))
         return traces
 
+    @classmethod
+    def stream_search(cls, regex: Union[re.Pattern, 'PatternSet'], chunks: Iterable[str], skip_kinds: int = 0,
+                      nesting: bool = False, changed_lines: Sequence[Tuple[int, int]] = None
+                      ) -> Union[List[Tuple[str, str]], List[List[Tuple[str, str]]]]:
+        # Same results as `simple_mode_search`/`nesting_mode_search` (single-pass lexer) for content given as
+        # pieces that end with a line break (but the last), while holding only a window of it. A window is lexed,
+        # masked and searched, and everything before its last line start that no token, flow control header or
+        # match crosses is final: its headers and brackets feed a `ScopeTracker` and its matches are reported.
+        # The rest is carried into the next window, so the lexer restarts only at line starts outside tokens.
+        # A nesting trace is kept until all headers that may enclose its match are ended or discarded; the
+        # headers that may still enclose the next position are kept as a stack (they nest like scopes do).
+        # A token or match longer than a window makes the window grow, and so does code without `{`, `}`, `;`;
+        # the regex sees `context_size` chars of masked content before a window, lookarounds and matches must
+        # fit in that plus the window.
+        context_size = 1024
+        result = []
+        waiting = collections.deque()  # nesting traces: [trace, match line, match position, candidate headers]
+        tracker = ScopeTracker()
+        open_headers = []  # stack of the headers that may enclose the next position, outermost first
+        offset = line_offset = 0
+        context = ''
+        text = ''
+        chunks = iter(chunks)
+        final = False
+        while not final:
+            chunk = next(chunks, None)
+            if chunk is None:
+                final = True
+            else:
+                text += chunk
+            spans = cls.tokenize(text)
+            masked_text = cls.mask(text, spans, skip_kinds) if skip_kinds else text
+            clean_text = cls.mask(text, spans, int(TokenKind.ALL)) if nesting else None
+            headers_found = [match.span(0) for match in cls.flow_control_regex.finditer(clean_text)] if nesting else []
+            searched_text = context + masked_text
+            matches = [(match.start() - len(context), match.end() - len(context), match)
+                       for match in regex.finditer(searched_text, len(context))]
+
+            if final:
+                cut = len(text)
+            else:
+                cut = text.rfind('\n', 0, len(text) - 1) + 1
+                if nesting:
+                    # the lookaheads of a header after the last `{`, `}` or `;` may need the next window,
+                    # without them any code of the window may start such a header
+                    last_bracket = max(clean_text.rfind('{'), clean_text.rfind('}'), clean_text.rfind(';'))
+                    if last_bracket < 0:
+                        last_bracket = len(clean_text) - len(clean_text.lstrip())
+                    if last_bracket < len(clean_text):
+                        cut = min(cut, text.rfind('\n', 0, last_bracket) + 1)
+                while cut > 0:
+                    new_cut = cut
+                    for start, end, _ in reversed(spans):
+                        if start < new_cut < end:
+                            new_cut = text.rfind('\n', 0, start) + 1
+                    for start, end, _ in matches:
+                        if start < new_cut < end:
+                            new_cut = text.rfind('\n', 0, start) + 1
+                    for start, end in reversed(headers_found):
+                        if start < new_cut < end:
+                            new_cut = text.rfind('\n', 0, start) + 1
+                    if new_cut == cut:
+                        break
+                    cut = new_cut
+                if cut == 0:
+                    continue
+
+            line_index = LineIndex(text)
+            matches = [match for match in matches if match[0] < cut]
+            if changed_lines is not None:
+                matches = [match for match in matches
+                           if cls.intersects(changed_lines, line_offset + line_index.line_number(match[0]),
+                                             line_offset + line_index.line_number(match[1]))]
+
+            def describe(start: int, end: int, match: re.Match) -> Tuple[Occurrence, str, str]:
+                occ = cls.determine_occurrence(text, start, end, line_index)
+                snippet = text[occ['abs_start_of_start_block']:occ['abs_end_of_end_block']]
+                return occ, snippet, f" [{regex.tag(match)}]" if isinstance(regex, PatternSet) else ''
+
+            def close_headers(position: int):
+                # pops the headers that ended before `position` or were discarded
+                while open_headers and open_headers[-1][3] != -1 and \
+                        (open_headers[-1][3] is None or open_headers[-1][3] < position):
+                    open_headers.pop()
+
+            if not nesting:
+                for start, end, match in matches:
+                    occ, snippet, tag = describe(start, end, match)
+                    format_string = f"{1 + line_offset + occ['block_index_start']}:" \
+                                    f"{1 + occ['matched_position_in_start_block']}-" \
+                                    f"{1 + line_offset + occ['block_index_end']}:" \
+                                    f"{1 + occ['matched_position_in_end_block']}"
+                    result.append((snippet, format_string + tag))
+            else:
+                # headers, matches and brackets in the order of their positions: a header or match at a bracket
+                # comes before it (the scan of a header starts with its first char)
+                header_starts = [start for start, _ in headers_found if start < cut]
+                h = m = 0
+                events = cls.bracket_regex.finditer(clean_text, 0, cut)
+                for event in itertools.chain(events, [None]):
+                    position = event.start() if event is not None else cut
+                    while True:
+                        header_start = header_starts[h] if h < len(header_starts) else cut
+                        match_start = matches[m][0] if m < len(matches) else cut
+                        if header_start <= position and header_start <= match_start and h < len(header_starts):
+                            line_number = line_index.line_number(header_start)
+                            header = [offset + header_start, line_offset + line_number,
+                                      text[line_index.line_start(line_number):line_index.line_end(line_number)],
+                                      -1, None]
+                            tracker.header(header)
+                            close_headers(header[0])
+                            open_headers.append(header)
+                            h += 1
+                        elif match_start <= position and m < len(matches):
+                            start, end, match = matches[m]
+                            occ, snippet, tag = describe(start, end, match)
+                            close_headers(offset + start)
+                            candidates = [header for header in open_headers if header[3] == -1 or
+                                          (header[3] is not None and header[3] >= offset + start)]
+                            waiting.append([[(snippet, cls.trace_location(occ, line_offset) + tag)],
+                                            line_offset + occ['block_index_start'], offset + start, candidates])
+                            m += 1
+                        else:
+                            break
+                    if event is not None:
+                        for header in tracker.bracket(offset + position, event.group(0)):
+                            header[4] = line_offset + line_index.line_number(position + 1)
+                if final:
+                    for header in tracker.finish(offset + len(text)):
+                        header[4] = line_offset + line_index.line_number(len(text))
+
+            # traces whose candidate headers are all resolved are complete
+            while waiting and all(header[3] != -1 for header in waiting[0][3]):
+                trace, last_line, position, candidates = waiting.popleft()
+                for header in sorted(candidates, key=lambda header: header[0], reverse=True):
+                    if header[3] is None or header[3] < position or header[1] == last_line:
+                        continue
+                    format_string = f"{1 + header[1]}-{1 + header[4]}" if header[1] != header[4] \
+                        else f"{1 + header[1]}"
+                    trace.append((header[2], format_string))
+                    last_line = header[1]
+                result.append(trace[::-1])
+
+            context = masked_text[max(0, cut - context_size):cut]
+            offset += cut
+            line_offset += text.count('\n', 0, cut)
+            text = text[cut:]
+        return result
+
+    @classmethod
+    def iter_matches(cls, regex: Union[re.Pattern, 'PatternSet'], file_content: str, skip_kinds: int = 0, *,
+                     nesting: bool = False, spans: List[Span] = None,
+                     scopes: Tuple[List[int], List[int]] = None, file: str = None,
+                     changed_lines: Sequence[Tuple[int, int]] = None) -> Iterator[Match]:
+        # Lazy counterpart of `simple_mode_search`/`nesting_mode_search` (single-pass lexer): yields a `Match`
+        # per match as the regex finds it, so a consumer that stops early does not pay for the rest.
+        # The scopes of a match are the ones `nesting_mode_search` prints in its trace.
+        masked_file_content = file_content
+        if skip_kinds or (nesting and scopes is None):
+            if spans is None:
+                spans = cls.tokenize(file_content)
+            if skip_kinds:
+                masked_file_content = cls.mask(file_content, spans, skip_kinds)
+        line_index = LineIndex(file_content)
+        scope_stack = None
+        scope_objects = {}
+        if nesting:
+            if scopes is None:
+                scopes = cls.determine_scopes(cls.mask(file_content, spans, int(TokenKind.ALL)))
+            scope_stack = ScopeStack(*scopes)
+        for match in regex.finditer(masked_file_content):
+            abs_start, abs_end = match.span(0)
+            if changed_lines is not None and not cls.intersects(changed_lines, line_index.line_number(abs_start),
+                                                                line_index.line_number(abs_end)):
+                continue
+            chain = ()
+            if scope_stack is not None:
+                chain = []
+                last_line = line_index.line_number(abs_start)
+                for i in scope_stack.enclosing(abs_start):
+                    scope = scope_objects.get(i)
+                    if scope is None:
+                        scope = scope_objects[i] = Scope(scopes[0][i], scopes[1][i], file_content, line_index)
+                    if scope.line_start - 1 == last_line:
+                        continue
+                    chain.append(scope)
+                    last_line = scope.line_start - 1
+                chain = tuple(reversed(chain))
+            yield Match(file, abs_start, abs_end, chain, file_content, line_index,
+                        regex.tag(match) if isinstance(regex, PatternSet) else None)
+
+
+# ========================================== FILE SEARCH ==========================================
+
+unicode_normalization_method = "NFKD"
+cpp_filename_regex = re.compile(r'^.*(?:\.cc|\.cpp|\.cxx|\.c|\.c\+\+|\.h|\.hpp|\.hh|\.hxx|\.h\+\+)$', re.MULTILINE)
+normalize_string_regex = re.compile(r'\s+')
+
+
+class LiteralPrefilter:
+    # Rejects a file by its raw bytes when one of the literals that every match of the regex must contain
+    # is missing. Only pure ASCII files are rejected: NFKD normalization of other files may produce a literal
+    # (e.g. `ﬁ` -> `fi`) that is absent from their bytes.
+    __slots__ = ('literals', 'literal_regexes')
+
+    max_literals = 3
+
+    def __init__(self, literals: Sequence[str], ignore_case: bool = False):
+        self.literals = [literal.encode('ascii') for literal in literals]
+        self.literal_regexes = [re.compile(re.escape(literal), re.IGNORECASE) for literal in self.literals] \
+            if ignore_case else None
+
+    @classmethod
+    def required_literals(cls, regex: re.Pattern) -> List[str]:
+        try:
+            from re import _parser as sre_parse
+        except ImportError:
+            import sre_parse
+        try:
+            parsed = sre_parse.parse(regex.pattern, regex.flags)
+        except Exception:
+            return []
+
+        def required_runs(subpattern) -> List[str]:
+            runs = []
+            run = []
+            for op, av in subpattern:
+                if op is sre_parse.LITERAL:
+                    run.append(chr(av))
+                    continue
+                if run:
+                    runs.append(''.join(run))
+                    run = []
+                if op is sre_parse.SUBPATTERN:
+                    group, add_flags, del_flags, p = av
+                    if not add_flags and not del_flags:
+                        runs.extend(required_runs(p))
+                elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                            getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+                    min_repeat, max_repeat, p = av
+                    if min_repeat >= 1:
+                        runs.extend(required_runs(p))
+                elif op is getattr(sre_parse, 'ATOMIC_GROUP', None):
+                    runs.extend(required_runs(av))
+            if run:
+                runs.append(''.join(run))
+            return runs
+
+        # files are read with universal newlines, so literals must not span line breaks
+        literals = [literal for run in required_runs(parsed) for literal in re.split(r'[\r\n]', run)
+                    if literal and literal.isascii()]
+        return sorted(set(literals), key=lambda literal: (-len(literal), literal))[:cls.max_literals]
+
+    @classmethod
+    def from_regex(cls, regex: re.Pattern) -> Optional['LiteralPrefilter']:
+        literals = cls.required_literals(regex)
+        if not literals:
+            return None
+        return cls(literals, ignore_case=bool(regex.flags & re.IGNORECASE))
+
+    def may_match_text(self, text: str) -> bool:
+        # same as `may_match` for the decoded content of a pure ASCII file
+        if self.literal_regexes is not None:
+            return all(re.search(re.escape(literal.decode('ascii')), text, re.IGNORECASE)
+                       for literal in self.literals)
+        return all(text.find(literal.decode('ascii')) != -1 for literal in self.literals)
+
+    def may_match(self, data: Union[bytes, mmap.mmap]) -> bool:
+        if self.literal_regexes is not None:
+            return all(literal_regex.search(data) for literal_regex in self.literal_regexes)
+        return all(data.find(literal) != -1 for literal in self.literals)
+
+
+class LinearRegex:
+    # A regex run by google-re2 (`pip install google-re2`, optional): linear time in the searched text, so no
+    # catastrophic backtracking. It has the parts of `re.Pattern` the searcher uses; `compile` gives None for
+    # patterns RE2 cannot run the way `re` does (backreferences, lookarounds, atomic groups, `\Z`, `$` without
+    # the M flag, the A, L and U flags). `\w`, `\d`, `\s` and `\b` are ASCII-only in RE2.
+    __slots__ = ('pattern', 'flags', 'regex')
+
+    inline_flags = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'), (re.DOTALL, 's'))
+
+    def __init__(self, pattern: str, flags: int, regex: Any):
+        self.pattern = pattern
+        self.flags = flags
+        self.regex = regex
+
+    def __reduce__(self):
+        return LinearRegex.compile, (self.pattern, self.flags)
+
+    def __repr__(self):
+        return f're2.compile({self.pattern!r}, {self.flags})'
+
+    def finditer(self, string: str, pos: int = 0) -> Iterator[Any]:
+        return self.regex.finditer(string, pos)
+
+    @classmethod
+    def needs_re(cls, pattern: str, flags: int) -> bool:
+        try:
+            from re import _parser as sre_parse, _constants as sre_constants
+        except ImportError:
+            import sre_parse, sre_constants
+        unsupported = {sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS, sre_constants.ASSERT,
+                       sre_constants.ASSERT_NOT, getattr(sre_constants, 'ATOMIC_GROUP', None),
+                       getattr(sre_constants, 'POSSESSIVE_REPEAT', None),
+                       getattr(sre_constants, 'GROUPREF_IGNORE', None)}
+
+        # `$` without M also matches before a final line break in `re`, only at the very end in RE2
+        at_ends = {sre_constants.AT_END_STRING, sre_constants.AT_END}
+
+        def walk(item) -> bool:
+            if isinstance(item, sre_parse.SubPattern):
+                return any(op in unsupported or (op is sre_constants.AT and av in at_ends) or
+                           walk(av) for op, av in item)
+            if isinstance(item, (tuple, list)):
+                return any(walk(i) for i in item)
+            return False
+
+        if flags & (re.ASCII | re.LOCALE | re.UNICODE):
+            return True
+        parsed = sre_parse.parse(pattern, flags)
+        if parsed.state.flags & (re.ASCII | re.LOCALE):
+            return True
+        if parsed.state.flags & re.MULTILINE:
+            at_ends.discard(sre_constants.AT_END)
+        return walk(parsed)
+
+    @classmethod
+    def compile(cls, pattern: str, flags: int) -> Optional['LinearRegex']:
+        if re2 is None or cls.needs_re(pattern, flags):
+            return None
+        inline = ''.join(letter for flag, letter in cls.inline_flags if flags & flag)
+        try:
+            regex = re2.compile(f'(?{inline}){pattern}' if inline else pattern)
+        except re2.error:
+            return None
+        return cls(pattern, flags, regex)
+
+
+class PatternSet:
+    # Several regexes searched over the same prepared file content: `finditer` yields the matches of all of
+    # them ordered by position, then by pattern order, so a file is read, masked and scoped once for all of
+    # them. The regexes are run one by one rather than as one alternation, which would drop the matches that
+    # overlap a match of an earlier pattern; patterns whose required literals are missing are not run.
+    # Identical patterns are run once and tagged with all their IDs.
+    __slots__ = ('regexes', 'tags', 'prefilters')
+
+    def __init__(self, patterns: Sequence[Tuple[str, re.Pattern]]):
+        self.regexes = []
+        self.tags = {}
+        for pattern_id, regex in patterns:
+            key = regex.regex if isinstance(regex, LinearRegex) else regex  # `match.re` of its matches
+            if key in self.tags:
+                self.tags[key] += ',' + pattern_id
+            else:
+                self.regexes.append(regex)
+                self.tags[key] = pattern_id
+        self.prefilters = [LiteralPrefilter.from_regex(regex) for regex in self.regexes]
+
+    def __repr__(self):
+        return 'PatternSet([' + ', '.join(f'({self.tag_of(regex)!r}, {regex!r})' for regex in self.regexes) + '])'
+
+    def tag_of(self, regex: Union[re.Pattern, LinearRegex]) -> str:
+        return self.tags[regex.regex if isinstance(regex, LinearRegex) else regex]
+
+    def tag(self, match: re.Match) -> str:
+        return self.tags[match.re]
+
+    def finditer(self, string: str, pos: int = 0) -> Iterator[re.Match]:
+        iterators = []
+        for i, (regex, prefilter) in enumerate(zip(self.regexes, self.prefilters)):
+            if prefilter is not None and not prefilter.may_match_text(string):
+                continue
+            iterators.append((match.start(), i, j, match) for j, match in enumerate(regex.finditer(string, pos)))
+        for _, _, _, match in heapq.merge(*iterators):
+            yield match
+
+    def prefilter(self) -> Optional['PatternSet']:
+        # the set itself rejects a file only when every pattern has literals and all of them reject it
+        return self if all(prefilter is not None for prefilter in self.prefilters) else None
+
+    def may_match(self, data: Union[bytes, mmap.mmap]) -> bool:
+        return any(prefilter.may_match(data) for prefilter in self.prefilters)
+
+    def may_match_text(self, text: str) -> bool:
+        return any(prefilter.may_match_text(text) for prefilter in self.prefilters)
+
+
+class FileAnalysis(TypedDict):
+    file_content: str
+    is_ascii: bool
+    spans: Optional[List[Span]]
+    scopes: Optional[Tuple[List[int], List[int]]]
+    # (size, mtime in ns, content hash) of the file, None if the file was rejected before decoding
+    cache_key: Optional[Tuple[int, int, bytes]]
+
+
+# (normalized content or None for ASCII files, spans, scopes or None) of a file, see `AnalysisCache`
+CacheEntry = Tuple[Optional[str], List[Span], Optional[Tuple[List[int], List[int]]]]
+
+
+class AnalysisCache:
+    # On-disk cache of per-file analysis: NFKD-normalized content (only for non-ASCII files, ASCII files are
+    # decoded again), lexer spans and nesting scopes. One binary file per source file: a fixed header followed
+    # by uint32 arrays; an entry is valid only for the same size, mtime and content hash of the source file.
+    # Entries are touched when used and the least recently used ones are evicted over `max_size` bytes.
+    __slots__ = ('cache_dir', 'max_size')
+
+    magic = b'CPPS'
+    version = 1
+    header = struct.Struct('<4sHHQQ16sIIQ')  # magic, version, flags, size, mtime_ns, hash, spans, scopes, text
+    has_scopes_flag = 1
+    has_text_flag = 2
+    offsets_typecode = 'I' if array.array('I').itemsize == 4 else 'L'
+    max_offset = (1 << 32) - 1
+
+    def __init__(self, cache_dir: str, max_size: int):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def content_hash(cls, data: Union[bytes, mmap.mmap]) -> bytes:
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    def entry_path(self, file: str) -> str:
+        key = os.path.abspath(file) + '\0' + locale.getpreferredencoding(False)
+        name = hashlib.sha1(key.encode('utf-8', 'surrogatepass')).hexdigest()
+        return os.path.join(self.cache_dir, name[:2], name[2:])
+
+    def load(self, file: str, cache_key: Tuple[int, int, bytes]) -> Optional[CacheEntry]:
+        # the entry of the file, None if it has none for `cache_key` or its entry is truncated or corrupt
+        path = self.entry_path(file)
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except OSError:
+            return None
+        if len(data) < self.header.size:
+            return None
+        magic, version, flags, size, mtime_ns, content_hash, spans_count, scopes_count, text_size = \
+            self.header.unpack_from(data)
+        if magic != self.magic or version != self.version or (size, mtime_ns, content_hash) != cache_key:
+            return None
+        offsets = array.array(self.offsets_typecode)
+        offsets_size = (3 * spans_count + 2 * scopes_count) * offsets.itemsize
+        if len(data) != self.header.size + offsets_size + text_size:
+            return None
+
+        offsets.frombytes(memoryview(data)[self.header.size:self.header.size + offsets_size])
+        spans = list(zip(offsets[0:3 * spans_count:3], offsets[1:3 * spans_count:3], offsets[2:3 * spans_count:3]))
+        scopes = None
+        if flags & self.has_scopes_flag:
+            scopes = (offsets[3 * spans_count:3 * spans_count + scopes_count].tolist(),
+                      offsets[3 * spans_count + scopes_count:].tolist())
+        text = None
+        if flags & self.has_text_flag:
+            try:
+                text = data[len(data) - text_size:].decode('utf-8', 'surrogatepass')
+            except UnicodeDecodeError:
+                return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return text, spans, scopes
+
+    def store(self, file: str, cache_key: Tuple[int, int, bytes], text: Optional[str], spans: List[Span],
+              scopes: Optional[Tuple[List[int], List[int]]]):
+        size, mtime_ns, content_hash = cache_key
+        if size > self.max_offset:
+            return
+        offsets = array.array(self.offsets_typecode)
+        for span in spans:
+            offsets.extend(span)
+        flags = 0
+        scopes_count = 0
+        if scopes is not None:
+            flags |= self.has_scopes_flag
+            scopes_count = len(scopes[0])
+            offsets.extend(scopes[0])
+            offsets.extend(scopes[1])
+        text_bytes = b''
+        if text is not None:
+            flags |= self.has_text_flag
+            text_bytes = text.encode('utf-8', 'surrogatepass')
+
+        path = self.entry_path(file)
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, 'wb') as fp:
+                fp.write(self.header.pack(self.magic, self.version, flags, size, mtime_ns, content_hash,
+                                          len(spans), scopes_count, len(text_bytes)))
+                fp.write(offsets.tobytes())
+                fp.write(text_bytes)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    entry_stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, path))
+                total_size += entry_stat.st_size
+        if total_size <= self.max_size:
+            return
+        entries.sort()
+        for _, entry_size, path in entries:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= entry_size
+            if total_size <= self.max_size:
+                break
+
+
+class SearchOptions(TypedDict):
+    mode: Literal['simple', 'nesting']
+    regex: Union[re.Pattern, PatternSet]
+    regex_for_single_line_skip: Optional[re.Pattern]
+    regex_for_multi_line_skip: Optional[re.Pattern]
+    skip_kinds: Optional[int]
+    prefilter: Union[LiteralPrefilter, PatternSet, None]
+    search_binary: bool
+    cache: Optional[AnalysisCache]
+    output_format: Literal['text', 'jsonl', 'tsv']
+    snippet: bool
+    stream_size: int
+    changed_lines: Optional[Dict[str, List[Tuple[int, int]]]]  # file -> lines to report matches in, see `git_diff`
+    git_revision: Optional[str]  # files are read from this revision if set, see `git_show`
+    verbose: bool
+
+
+mmap_min_size = 1 << 20
+stream_window_size = 4 << 20
+binary_check_size = 8192
+non_ascii_regex = re.compile(rb'[\x80-\xff]')
+
+
+def read_file(file: str, prefilter: Union[LiteralPrefilter, PatternSet, None] = None, search_binary: bool = False,
+              cache: Optional[AnalysisCache] = None, data: Optional[bytes] = None) -> Optional[FileAnalysis]:
+    # Reads a file as `open(file, 'r').read()` normalized with NFKD would, but looks at the raw bytes first:
+    # returns None for binary files, an empty analysis for files rejected by `prefilter`, skips NFKD for
+    # pure ASCII files and takes spans, scopes and normalized content from `cache` when it has them.
+    # Given `data`, analyses it as the content of the file instead (without `cache`).
+    if profiler is not None:
+        time_start = time.perf_counter()
+    if data is None:
+        with open(file, 'rb') as fp:
+            file_stat = os.fstat(fp.fileno())
+            size = file_stat.st_size
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) if size >= mmap_min_size else fp.read()
+    else:
+        size = len(data)
+        cache = None
+    if profiler is not None:
+        profiler.count('bytes_read', size)
+    try:
+        if not search_binary and data[:binary_check_size].find(b'\0') != -1:
+            if profiler is not None:
+                profiler.add('read', time_start)
+                profiler.count('files_binary')
+            return None
+        is_ascii = non_ascii_regex.search(data) is None
+        if is_ascii and prefilter is not None and not prefilter.may_match(data):
+            if profiler is not None:
+                profiler.add('read', time_start)
+                profiler.count('files_prefiltered')
+            return FileAnalysis(file_content='', is_ascii=True, spans=[], scopes=([], []), cache_key=None)
+        cache_key = None
+        if cache is not None:
+            cache_key = (size, file_stat.st_mtime_ns, cache.content_hash(data))
+            cached = cache.load(file, cache_key)
+            if cached is not None and (is_ascii or cached[0] is not None):
+                if profiler is not None:
+                    profiler.add('read', time_start)
+                    profiler.count('cache_hits')
+                    time_start = time.perf_counter()
+                text, spans, scopes = cached
+                if text is None:
+                    text = (data if isinstance(data, bytes) else data[:]).decode(locale.getpreferredencoding(False))
+                    if '\r' in text:
+                        text = text.replace('\r\n', '\n').replace('\r', '\n')
+                if profiler is not None:
+                    profiler.add('decode', time_start)
+                return FileAnalysis(file_content=text, is_ascii=is_ascii, spans=spans, scopes=scopes,
+                                    cache_key=cache_key)
+        if profiler is not None:
+            profiler.add('read', time_start)
+            time_start = time.perf_counter()
+        file_content = (data if isinstance(data, bytes) else data[:]).decode(locale.getpreferredencoding(False))
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+    if '\r' in file_content:
+        file_content = file_content.replace('\r\n', '\n').replace('\r', '\n')
+    if profiler is not None:
+        profiler.add('decode', time_start)
+    if not is_ascii:
+        if profiler is not None:
+            time_start = time.perf_counter()
+        file_content = unicodedata.normalize(unicode_normalization_method, file_content)
+        if profiler is not None:
+            profiler.add('normalize', time_start)
+    return FileAnalysis(file_content=file_content, is_ascii=is_ascii, spans=None, scopes=None, cache_key=cache_key)
+
+
+def glob_matches(name: str, path: str, globs: Sequence[str]) -> bool:
+    # `path` is relative to the searched dir, so that `src/*` matches whatever the dir is given as
+    return any(fnmatch.fnmatch(name, glob) or fnmatch.fnmatch(path, glob) for glob in globs)
+
+
+def discover_files(paths: Iterable[str], *, include: Sequence[str] = (), exclude: Sequence[str] = (),
+                   extensions: Sequence[str] = (), cpp_only: bool = False, follow_links: bool = False,
+                   verbose_stderr: bool = False) -> Iterator[str]:
+    # lazily yields the files to search in the order of `os.walk`; files in dirs are filtered by
+    # `stat` size, globs and extensions without being opened
+    extensions = tuple('.' + extension.lstrip('.') for extension in extensions)
+    matches = glob_matches
+
+    for path in paths:
+        path = os.path.normpath(path)
+        if os.path.isdir(path):
+            visited = set()
+            stack = [(path, '')]
+            while stack:
+                dir_path, relative_dir = stack.pop()
+                if follow_links:
+                    try:
+                        dir_stat = os.stat(dir_path)
+                    except OSError:
+                        continue
+                    if (dir_stat.st_dev, dir_stat.st_ino) in visited:
+                        if verbose_stderr:
+                            print(f'Dir {dir_path} is a symbolic link loop, skipped', file=sys.stderr)
+                        continue
+                    visited.add((dir_stat.st_dev, dir_stat.st_ino))
+                try:
+                    with os.scandir(dir_path) as it:
+                        entries = list(it)
+                except OSError:
+                    continue
+                dir_paths = []
+                for entry in entries:
+                    relative_path = os.path.join(relative_dir, entry.name) if relative_dir else entry.name
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+                    if is_dir:
+                        if (follow_links or not entry.is_symlink()) and \
+                                not matches(entry.name, relative_path, exclude):
+                            dir_paths.append((entry.path, relative_path))
+                        continue
+                    if exclude and matches(entry.name, relative_path, exclude):
+                        continue
+                    if include and not matches(entry.name, relative_path, include):
+                        continue
+                    if extensions and not entry.name.endswith(extensions):
+                        continue
+                    if cpp_only and not cpp_filename_regex.match(entry.name):
+                        continue
+                    try:
+                        file_stat = entry.stat()
+                    except OSError:
+                        if profiler is not None:
+                            profiler.count('files_skipped')
+                        if verbose_stderr:
+                            print(f'File {entry.path} cannot be open for reading, skipped', file=sys.stderr)
+                        continue
+                    if profiler is not None and (not stat.S_ISREG(file_stat.st_mode) or not file_stat.st_size):
+                        profiler.count('files_skipped')
+                    if not stat.S_ISREG(file_stat.st_mode):
+                        if verbose_stderr:
+                            print(f'File {entry.path} is not a regular file, skipped', file=sys.stderr)
+                    elif file_stat.st_size > 0:
+                        yield entry.path
+                    elif verbose_stderr:
+                        print(f'File {entry.path} is empty, skipped', file=sys.stderr)
+                stack.extend(reversed(dir_paths))
+        elif os.path.isfile(path):
+            yield path
+        elif verbose_stderr:
+            print(f'Object {path} is not dir or file, skipped', file=sys.stderr)
+
+
+tsv_escape_table = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+
+def escape_tsv(text: str) -> str:
+    # `str.translate` is slow, most fields have nothing to escape
+    if '\\' in text or '\t' in text or '\n' in text or '\r' in text:
+        return text.translate(tsv_escape_table)
+    return text
+
+
+def format_matches(file: str, matches: Iterable[Match], output_format: Literal['jsonl', 'tsv'],
+                   snippet: bool = True) -> str:
+    # One record per match, for tools: a JSON object per line, or tab-separated
+    # `file line column end_line end_column start end pattern scopes snippet` with `\`, tabs and line breaks
+    # escaped (`scopes` is `line-end_line,...`, outermost first). Lines and columns are 1-based as in the text
+    # output, offsets are 0-based into the normalized content. The lines of a match and the header lines of
+    # its scopes are sliced only if `snippet` is set.
+    result = []
+    if output_format == 'jsonl':
+        file_json = json.dumps(file)
+        for match in matches:
+            record = (f'{{"file":{file_json},"start":{match.start},"end":{match.end},'
+                      f'"line":{match.line_start},"column":{match.column_start},'
+                      f'"end_line":{match.line_end},"end_column":{match.column_end}')
+            if match.pattern is not None:
+                record += f',"pattern":{json.dumps(match.pattern)}'
+            if match.scopes:
+                if snippet:
+                    record += ',"scopes":[' + ','.join(
+                        f'{{"line":{scope.line_start},"end_line":{scope.line_end},"text":{json.dumps(scope.header)}}}'
+                        for scope in match.scopes) + ']'
+                else:
+                    record += ',"scopes":[' + ','.join(f'{{"line":{scope.line_start},"end_line":{scope.line_end}}}'
+                                                       for scope in match.scopes) + ']'
+            if snippet:
+                record += f',"text":{json.dumps(match.lines)}'
+            result.append(record + '}\n')
+    else:  # 'tsv'
+        file_tsv = escape_tsv(file)
+        for match in matches:
+            scopes = ','.join(f'{scope.line_start}-{scope.line_end}' for scope in match.scopes)
+            result.append(f'{file_tsv}\t{match.line_start}\t{match.column_start}\t{match.line_end}\t'
+                          f'{match.column_end}\t{match.start}\t{match.end}\t'
+                          f'{escape_tsv(match.pattern or "")}\t{scopes}\t'
+                          f'{escape_tsv(match.lines) if snippet else ""}\n')
+    return ''.join(result)
+
+
+def format_occurrences(file: str, occurrences: List[Tuple[str, str]]) -> str:
+    indent = ' ' * 4
+    result = []
+    for s, p in occurrences:
+        s = repr(normalize_string_regex.sub(' ', s.strip()))[1:-1]
+        result.append(f"{file}:{p}\n{indent + s}")
+    return '\n'.join(result) + '\n\n' if result else ''
+
+
+def format_traces(file: str, traces: List[List[Tuple[str, str]]]) -> str:
+    indent = ' ' * 4
+    result = []
+    for trace in traces:
+        str_trace_list = []
+        for s, p in trace:
+            s = repr(normalize_string_regex.sub(' ', s.strip()))[1:-1]
+            str_trace_list.append(f"{file}:{p}\n{indent + s}")
+        if str_trace_list:
+            result.append('\n'.join(str_trace_list))
+    return '\n\n'.join(result) + '\n\n' if result else ''
+
+
+def search_analysis(file: str, analysis: FileAnalysis, options: SearchOptions) -> str:
+    # output of one read file, formatted exactly as it is printed
+    mode = options['mode']
+    regex = options['regex']
+    file_content = analysis['file_content']
+    nesting = mode == 'nesting' and cpp_filename_regex.match(file)
+    spans = analysis['spans']
+    scopes = analysis['scopes']
+    changed_lines = options['changed_lines'][file] if options['changed_lines'] is not None else None
+    # a file read without a cache hit has no spans yet: its entry is stored with them (and its normalized
+    # content), whether this search needs them or not, so that later searches with other options hit it too
+    if options['cache'] is not None and analysis['cache_key'] is not None and \
+            options['skip_kinds'] is not None and (spans is None or (nesting and scopes is None)):
+        if profiler is not None:
+            time_start = time.perf_counter()
+        if spans is None:
+            spans = CppBaseMethods.tokenize(file_content)
+        if profiler is not None:
+            profiler.add('mask', time_start)
+            time_start = time.perf_counter()
+        if nesting and scopes is None:
+            scopes = CppBaseMethods.determine_scopes(
+                CppBaseMethods.mask(file_content, spans, int(TokenKind.ALL)))
+        if profiler is not None:
+            profiler.add('scopes', time_start)
+        options['cache'].store(file, analysis['cache_key'],
+                               None if analysis['is_ascii'] else file_content, spans, scopes)
+    if options['output_format'] != 'text':
+        # records need offsets, so they are built from `iter_matches` (single-pass lexer only)
+        if profiler is not None:
+            time_start = time.perf_counter()
+        matches = list(CppBaseMethods.iter_matches(regex, file_content, options['skip_kinds'],
+                                                   nesting=bool(nesting), spans=spans, scopes=scopes, file=file,
+                                                   changed_lines=changed_lines))
+        if profiler is not None:
+            profiler.add('search', time_start)
+            profiler.count('matches', len(matches))
+            time_start = time.perf_counter()
+        output = format_matches(file, matches, options['output_format'], options['snippet'])
+    elif nesting:
+        traces = CppBaseMethods.nesting_mode_search(regex, file_content,
+                                                    options['regex_for_single_line_skip'],
+                                                    options['regex_for_multi_line_skip'],
+                                                    options['skip_kinds'], spans, scopes, changed_lines)
+        if profiler is not None:
+            time_start = time.perf_counter()
+        output = format_traces(file, traces)
+    else:  # 'simple' text
+        occurrences = CppBaseMethods.simple_mode_search(regex, file_content,
+                                                        options['regex_for_single_line_skip'],
+                                                        options['regex_for_multi_line_skip'],
+                                                        options['skip_kinds'], spans, changed_lines)
+        if profiler is not None:
+            time_start = time.perf_counter()
+        output = format_occurrences(file, occurrences)
+    if profiler is not None:
+        profiler.add('format', time_start)
+    return output
+
+
+def read_chunks(fp: BinaryIO, chunk_size: int = stream_window_size) -> Iterator[str]:
+    # the content `read_file` gives for the file, in pieces of about `chunk_size` bytes that end with a line
+    # break (but the last); NFKD normalization does not cross line breaks, so pieces are normalized alone
+    decoder = codecs.getincrementaldecoder(locale.getpreferredencoding(False))()
+    pending = ''
+    while True:
+        data = fp.read(chunk_size)
+        text = pending + decoder.decode(data, final=not data)
+        pending = ''
+        if data and text.endswith('\r'):
+            text, pending = text[:-1], '\r'  # may be followed by `\n`
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        if data:
+            cut = text.rfind('\n') + 1
+            text, pending = text[:cut], text[cut:] + pending
+        if not text.isascii():
+            text = unicodedata.normalize(unicode_normalization_method, text)
+        if text:
+            yield text
+        if not data:
+            return
+
+
+def search_stream(file: str, options: SearchOptions) -> Optional[str]:
+    # output of a file searched by `CppBaseMethods.stream_search` without reading it whole, None for binary files;
+    # pure ASCII files are checked by the prefilter on a map of their bytes first, as `read_file` does
+    with open(file, 'rb') as fp:
+        if not options['search_binary'] and fp.read(binary_check_size).find(b'\0') != -1:
+            return None
+        if options['prefilter'] is not None:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if non_ascii_regex.search(data) is None and not options['prefilter'].may_match(data):
+                    if profiler is not None:
+                        profiler.count('files_prefiltered')
+                    return ''
+        fp.seek(0)
+        nesting = options['mode'] == 'nesting' and bool(cpp_filename_regex.match(file))
+        changed_lines = options['changed_lines'][file] if options['changed_lines'] is not None else None
+        result = CppBaseMethods.stream_search(options['regex'], read_chunks(fp), options['skip_kinds'], nesting,
+                                              changed_lines)
+    if profiler is not None:
+        profiler.count('files_streamed')
+    return format_traces(file, result) if nesting else format_occurrences(file, result)
+
+
+def search_file(file: str, options: SearchOptions) -> Tuple[str, str]:
+    # returns (output, errors) of one file, formatted exactly as they are printed
+    try:
+        if options['git_revision'] is not None:
+            analysis = read_file(file, options['prefilter'], options['search_binary'],
+                                 data=git_show(options['git_revision'], file))
+        elif options['stream_size'] and options['skip_kinds'] is not None and options['output_format'] == 'text' \
+                and os.stat(file).st_size >= options['stream_size']:
+            output = search_stream(file, options)
+            if output is not None:
+                return output, ''
+            analysis = None
+        else:
+            analysis = read_file(file, options['prefilter'], options['search_binary'], options['cache'])
+        if analysis is None:
+            if options['verbose']:
+                return '', f'File {file} is binary, skipped\n'
+        else:
+            return search_analysis(file, analysis, options), ''
+    except BaseException as e:
+        if profiler is not None:
+            profiler.count('files_failed')
+        if options['verbose']:
+            return '', f'{file} {e}\n'
+    return '', ''
+
+
+search_worker_options: Optional[SearchOptions] = None
+
+
+def init_search_worker(options: Optional[SearchOptions] = None):
+    # the options are sent to every pool process once, not with every file
+    global search_worker_options
+    warnings.filterwarnings("error")
+    search_worker_options = options
+
+
+def search_worker_file(file: str) -> Tuple[str, str]:
+    return search_file(file, search_worker_options)
+
+
+def search_files(files: Iterable[str], options: SearchOptions, *, jobs: int = 1) -> Iterator[Tuple[str, str]]:
+    # yields (output, errors) per file in the order of `files`; with several jobs every file is sent to
+    # a process pool on its own, a bounded number of files is in flight and every result is yielded as
+    # soon as all files before it are done. Files in flight when a pool process dies are reported in the
+    # errors as skipped and the rest are searched by a new pool
+    if jobs <= 1:
+        for file in files:
+            if profiler is not None:
+                time_start = time.perf_counter()
+                result = search_file(file, options)
+                profiler.count('files')
+                profiler.file_done(file, time.perf_counter() - time_start)
+                yield result
+            else:
+                yield search_file(file, options)
+        return
+
+    def new_executor() -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=init_search_worker,
+                                                      initargs=(options,))
+
+    files = iter(files)
+    max_pending = jobs * 4
+    executor = new_executor()
+    pending = collections.deque()
+    try:
+        while True:
+            while len(pending) < max_pending:
+                file = next(files, None)
+                if file is None:
+                    break
+                try:
+                    future = executor.submit(search_worker_file, file)
+                except concurrent.futures.BrokenExecutor:
+                    executor.shutdown(wait=False)
+                    executor = new_executor()
+                    future = executor.submit(search_worker_file, file)
+                pending.append((file, future))
+            if not pending:
+                break
+            file, future = pending.popleft()
+            try:
+                yield future.result()
+            except concurrent.futures.BrokenExecutor:
+                yield '', f'File {file} skipped: the search process stopped\n'
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def budget_worker(connection: multiprocessing.connection.Connection, options: SearchOptions):
+    init_search_worker()
+    while True:
+        file = connection.recv()
+        if file is None:
+            break
+        connection.send(search_file(file, options))
+
+
+class BudgetWorker:
+    # a search process that gets one file at a time, so a runaway file can be abandoned by killing it
+    # (a running regex can't be interrupted inside the process that runs it)
+    __slots__ = ('process', 'connection', 'index', 'file', 'deadline')
+
+    def __init__(self, options: SearchOptions):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=budget_worker, args=(child_connection, options), daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.index: Optional[int] = None
+        self.file: Optional[str] = None
+        self.deadline = math.inf
+
+    def submit(self, index: int, file: str, deadline: float):
+        self.index, self.file, self.deadline = index, file, deadline
+        self.connection.send(file)
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.connection.close()
+        self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def search_files_budgeted(files: Iterable[str], options: SearchOptions, *, jobs: int = 1,
+                          file_budget: float = 0.0, query_budget: float = 0.0,
+                          skipped: Optional[List[Tuple[str, str]]] = None) -> Iterator[Tuple[str, str]]:
+    # like search_files, but every file runs in a worker process that is killed when the file takes more
+    # than `file_budget` seconds; once `query_budget` seconds have passed the files in progress are
+    # abandoned and the rest are not searched. Skipped files are reported in the errors and appended
+    # to `skipped` as (file, reason)
+    files = enumerate(files)
+    query_deadline = time.monotonic() + query_budget if query_budget > 0 else math.inf
+    workers = [BudgetWorker(options) for _ in range(max(jobs, 1))]
+    results: Dict[int, Tuple[str, str]] = {}
+    reasons: Dict[int, Tuple[str, str]] = {}
+    next_index = 0
+    exhausted = False
+    try:
+        while True:
+            for worker in workers:
+                if worker.file is None and not exhausted:
+                    item = next(files, None)
+                    if item is None:
+                        exhausted = True
+                    else:
+                        now = time.monotonic()
+                        deadline = min(now + file_budget if file_budget > 0 else math.inf, query_deadline)
+                        worker.submit(*item, deadline)
+            busy = [worker for worker in workers if worker.file is not None]
+            if not busy:
+                break
+            timeout = min(worker.deadline for worker in busy) - time.monotonic()
+            ready = multiprocessing.connection.wait([worker.connection for worker in busy],
+                                                    None if timeout == math.inf else max(timeout, 0))
+            now = time.monotonic()
+            for i, worker in enumerate(workers):
+                if worker.file is None:
+                    continue
+                if worker.connection in ready:
+                    try:
+                        results[worker.index] = worker.connection.recv()
+                        worker.file = None
+                        continue
+                    except EOFError:
+                        reason = 'the search process stopped'
+                elif now >= query_deadline:
+                    reason = f'in progress when the query time budget of {query_budget} seconds was exhausted'
+                elif now >= worker.deadline:
+                    reason = f'exceeded the file time budget of {file_budget} seconds'
+                else:
+                    continue
+                results[worker.index] = ('', f'File {worker.file} skipped: {reason}\n')
+                reasons[worker.index] = (worker.file, reason)
+                worker.kill()
+                workers[i] = BudgetWorker(options)
+            while next_index in results:
+                if next_index in reasons and skipped is not None:
+                    skipped.append(reasons.pop(next_index))
+                yield results.pop(next_index)
+                next_index += 1
+            if now >= query_deadline:
+                if not exhausted and next(files, None) is not None:
+                    yield '', f'The query time budget of {query_budget} seconds was exhausted, ' \
+                              f'the remaining files are not searched\n'
+                break
+    finally:
+        for worker in workers:
+            if worker.file is None:
+                worker.stop()
+            else:
+                worker.kill()
+
+
+# ========================================== PYTHON API ==========================================
+
+def search(paths: Iterable[str], text: str = None, regex: Union[str, re.Pattern] = None, *,
+           mode: Literal['simple', 'nesting'] = 'simple', flags: int = 0,
+           ignore_comments: bool = False, ignore_directives: bool = False,
+           ignore_char_str_literals: bool = False, max_results: int = None,
+           first_match_per_file: bool = False, search_binary: bool = False,
+           cache: Optional[AnalysisCache] = None, **discover_options) -> Iterator[Match]:
+    # Lazily yields the matches of `text` or `regex` in the files of `paths` (dirs are walked like the CLI does,
+    # `discover_options` are passed to `discover_files`). Files are read only when the consumer asks for their
+    # matches; `max_results` and `first_match_per_file` stop the search early. Unreadable files are skipped.
+    # The arguments are checked and the regex compiled when `search` is called.
+    if text is None and regex is None:
+        raise ValueError('one of `text` and `regex` is required')
+    if mode not in {'simple', 'nesting'}:
+        raise ValueError(f'mode must be `simple` or `nesting`, not {mode!r}')
+    if text is not None:
+        regex = re.escape(text)
+    if isinstance(regex, str):
+        regex = compile_regex(regex, flags)
+    skip_kinds = CppBaseMethods.skip_kinds(comments=ignore_comments, directives=ignore_directives,
+                                           char_str_literals=ignore_char_str_literals)
+    prefilter = LiteralPrefilter.from_regex(regex)
+    nesting = mode == 'nesting'
+
+    def matches() -> Iterator[Match]:
+        if max_results is not None and max_results <= 0:
+            return
+        results = 0
+        for file in discover_files(paths, **discover_options):
+            try:
+                analysis = read_file(file, prefilter, search_binary, cache)
+            except (OSError, UnicodeError):
+                continue
+            if analysis is None or not analysis['file_content']:
+                continue
+            for match in CppBaseMethods.iter_matches(regex, analysis['file_content'], skip_kinds,
+                                                     nesting=nesting and bool(cpp_filename_regex.match(file)),
+                                                     spans=analysis['spans'], scopes=analysis['scopes'], file=file):
+                yield match
+                results += 1
+                if max_results is not None and results >= max_results:
+                    return
+                if first_match_per_file:
+                    break
+
+    return matches()
+
+
+# ========================================== TRIGRAM INDEX ==========================================
+
+def encode_varint(value: int, out: bytearray):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data: Union[bytes, memoryview], pos: int) -> Tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+class TrigramIndex:
+    # Trigram posting lists of the lowercased bytes of pure ASCII files. Files that are not pure ASCII (NFKD
+    # may create literals that their bytes lack) or are binary are marked to be searched always.
+    # On disk: header, file table (varint-prefixed utf-8 path, varint size, varint mtime in ns, flags byte),
+    # sorted uint32 trigrams with uint64 offsets of their posting lists, and the posting lists (varint count
+    # followed by varint deltas of ascending file ids).
+    __slots__ = ('files', 'file_ids', 'trigrams', 'offsets', 'postings')
+
+    magic = b'CPPI'
+    version = 1
+    header = struct.Struct('<4sHII')  # magic, version, files, trigrams
+    always_search_flag = 1
+
+    def __init__(self, files: List[Tuple[str, int, int, int]], trigrams: array.array, offsets: array.array,
+                 postings: Union[bytes, memoryview]):
+        self.files = files
+        self.file_ids = {file[0]: file_id for file_id, file in enumerate(files)}
+        self.trigrams = trigrams
+        self.offsets = offsets
+        self.postings = postings
+
+    @classmethod
+    def file_trigrams(cls, data: bytes) -> Set[int]:
+        data = data.lower()
+        return {a << 16 | b << 8 | c for a, b, c in set(zip(data, data[1:], data[2:]))}
+
+    @classmethod
+    def load(cls, index_path: str) -> 'TrigramIndex':
+        with open(index_path, 'rb') as fp:
+            data = memoryview(fp.read())
+        magic, version, files_count, trigrams_count = cls.header.unpack_from(data)
+        if magic != cls.magic or version != cls.version:
+            raise ValueError(f'{index_path} is not a trigram index of this version')
+        pos = cls.header.size
+        files = []
+        for _ in range(files_count):
+            length, pos = decode_varint(data, pos)
+            path = bytes(data[pos:pos + length]).decode('utf-8', 'surrogateescape')
+            pos += length
+            size, pos = decode_varint(data, pos)
+            mtime_ns, pos = decode_varint(data, pos)
+            files.append((path, size, mtime_ns, data[pos]))
+            pos += 1
+        trigrams = array.array('I')
+        trigrams.frombytes(data[pos:pos + trigrams_count * trigrams.itemsize])
+        pos += trigrams_count * trigrams.itemsize
+        offsets = array.array('Q')
+        offsets.frombytes(data[pos:pos + trigrams_count * offsets.itemsize])
+        pos += trigrams_count * offsets.itemsize
+        return cls(files, trigrams, offsets, data[pos:])
+
+    def posting(self, trigram: int) -> List[int]:
+        i = bisect.bisect_left(self.trigrams, trigram)
+        if i == len(self.trigrams) or self.trigrams[i] != trigram:
+            return []
+        postings = self.postings
+        count, pos = decode_varint(postings, self.offsets[i])
+        file_ids = []
+        file_id = 0
+        for _ in range(count):
+            delta, pos = decode_varint(postings, pos)
+            file_id += delta
+            file_ids.append(file_id)
+        return file_ids
+
+    def file_postings(self) -> Dict[int, List[int]]:
+        # trigrams of every indexed file
+        result = collections.defaultdict(list)
+        for trigram in self.trigrams:
+            for file_id in self.posting(trigram):
+                result[file_id].append(trigram)
+        return result
+
+    @classmethod
+    def write(cls, index_path: str, files: List[Tuple[str, int, int, int]], file_trigrams: List[Iterable[int]]):
+        postings = collections.defaultdict(list)
+        for file_id, trigrams in enumerate(file_trigrams):
+            for trigram in trigrams:
+                postings[trigram].append(file_id)
+
+        out = bytearray(cls.header.pack(cls.magic, cls.version, len(files), len(postings)))
+        for path, size, mtime_ns, flags in files:
+            path_bytes = path.encode('utf-8', 'surrogateescape')
+            encode_varint(len(path_bytes), out)
+            out += path_bytes
+            encode_varint(size, out)
+            encode_varint(mtime_ns, out)
+            out.append(flags)
+        trigrams = array.array('I', sorted(postings))
+        offsets = array.array('Q')
+        posting_lists = bytearray()
+        for trigram in trigrams:
+            offsets.append(len(posting_lists))
+            file_ids = postings[trigram]
+            encode_varint(len(file_ids), posting_lists)
+            previous = 0
+            for file_id in file_ids:
+                encode_varint(file_id - previous, posting_lists)
+                previous = file_id
+        out += trigrams.tobytes()
+        out += offsets.tobytes()
+        out += posting_lists
+
+        temp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as fp:
+            fp.write(out)
+        os.replace(temp_path, index_path)
+
+    @classmethod
+    def update(cls, index_path: str, files: Iterable[str], *, verbose_stderr: bool = False) -> Tuple[int, int]:
+        # (re)indexes new and changed files, keeps the trigrams of files with the same size and mtime;
+        # returns (files in the index, files (re)indexed)
+        try:
+            old_index = cls.load(index_path)
+            old_file_postings = old_index.file_postings()
+        except (OSError, ValueError, struct.error):
+            old_index = None
+            old_file_postings = {}
+
+        new_files = []
+        new_file_trigrams = []
+        indexed = 0
+        for file in files:
+            path = os.path.abspath(file)
+            try:
+                file_stat = os.stat(path)
+                old_id = old_index.file_ids.get(path) if old_index is not None else None
+                if old_id is not None and old_index.files[old_id][1:3] == (file_stat.st_size,
+                                                                           file_stat.st_mtime_ns):
+                    new_files.append(old_index.files[old_id])
+                    new_file_trigrams.append(old_file_postings.get(old_id, ()))
+                    continue
+                with open(path, 'rb') as fp:
+                    data = fp.read()
+            except OSError as e:
+                if verbose_stderr:
+                    print(file, e, file=sys.stderr)
+                continue
+            indexed += 1
+            if data[:binary_check_size].find(b'\0') != -1 or not data.isascii():
+                new_files.append((path, file_stat.st_size, file_stat.st_mtime_ns, cls.always_search_flag))
+                new_file_trigrams.append(())
+            else:
+                new_files.append((path, file_stat.st_size, file_stat.st_mtime_ns, 0))
+                new_file_trigrams.append(cls.file_trigrams(data))
+        cls.write(index_path, new_files, new_file_trigrams)
+        return len(new_files), indexed
+
+    def file_filter(self, regex: Union[re.Pattern, PatternSet]) -> Optional[Callable[[str], bool]]:
+        # predicate that is False only for indexed, unchanged files that cannot contain a match;
+        # None if the regex (or a regex of the set) has no literal of 3+ characters to query the index with
+        if isinstance(regex, PatternSet):
+            file_filters = [self.file_filter(pattern_regex) for pattern_regex in regex.regexes]
+            if any(file_filter is None for file_filter in file_filters):
+                return None
+            return lambda file: any(file_filter(file) for file_filter in file_filters)
+        trigrams = set()
+        for literal in LiteralPrefilter.required_literals(regex):
+            data = literal.encode('ascii').lower()
+            trigrams.update(a << 16 | b << 8 | c for a, b, c in zip(data, data[1:], data[2:]))
+        if not trigrams:
+            return None
+        candidates = None
+        for trigram in sorted(trigrams, key=lambda trigram: self.posting_size(trigram)):
+            file_ids = self.posting(trigram)
+            candidates = set(file_ids) if candidates is None else candidates.intersection(file_ids)
+            if not candidates:
+                break
+
+        def may_match(file: str) -> bool:
+            file_id = self.file_ids.get(os.path.abspath(file))
+            if file_id is None:
+                return True
+            path, size, mtime_ns, flags = self.files[file_id]
+            if flags & self.always_search_flag or file_id in candidates:
+                return True
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                return True
+            return (file_stat.st_size, file_stat.st_mtime_ns) != (size, mtime_ns)
+
+        return may_match
+
+    def posting_size(self, trigram: int) -> int:
+        i = bisect.bisect_left(self.trigrams, trigram)
+        if i == len(self.trigrams) or self.trigrams[i] != trigram:
+            return 0
+        return decode_varint(self.postings, self.offsets[i])[0]
+
+
+# ========================================== GIT ==========================================
+
+git_hunk_regex = re.compile(rb'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@')
+
+
+def run_git(*args: str, cwd: str = None) -> bytes:
+    # stdout of a git command; raises OSError if git cannot run or fails
+    result = subprocess.run(['git', *args], cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise OSError(result.stderr.decode(errors='replace').strip() or f'git {args[0]} failed')
+    return result.stdout
+
+
+def git_range_revision(revision_range: str) -> Optional[str]:
+    # the revision whose files `git diff <revision_range>` compares with (`B` of `A..B`, `A...B` and `B^!`,
+    # `HEAD` if `B` is left out), None for a single revision, which is compared with the working tree
+    if revision_range.endswith('^!'):
+        return revision_range[:-2]
+    left, dots, right = revision_range.partition('..')
+    if not dots:
+        return None
+    return right.lstrip('.') or 'HEAD'
+
+
+def git_show(revision: str, file: str) -> bytes:
+    # content of `file` (a path in the working tree) in a revision of its repository
+    dir_path, name = os.path.split(os.path.abspath(file))
+    return run_git('cat-file', 'blob', f'{revision}:./{name}', cwd=dir_path)
+
+
+def git_diff(revision_range: str, paths: Iterable[str]) -> Dict[str, List[Tuple[int, int]]]:
+    # real path of every file changed by `git diff <revision_range>` (a range or a revision compared with the
+    # working tree) in the repositories of `paths` -> sorted 0-based inclusive ranges of its added or changed
+    # lines; deleted files and files with only deleted lines are left out. Raises OSError if git cannot run or
+    # fails. The lines are those of the files in `git_range_revision(revision_range)` (see `git_show`)
+    top_levels = []
+    for path in paths:
+        path = os.path.normpath(path)
+        cwd = path if os.path.isdir(path) else os.path.dirname(path) or '.'
+        top_level = os.fsdecode(run_git('rev-parse', '--show-toplevel', cwd=cwd).rstrip(b'\n'))
+        if top_level not in top_levels:
+            top_levels.append(top_level)
+    changed_lines = {}
+    for top_level in top_levels:
+        changed_lines.update(git_diff_lines(revision_range, top_level))
+    return changed_lines
+
+
+def git_diff_lines(revision_range: str, top_level: str) -> Dict[str, List[Tuple[int, int]]]:
+    # `git_diff` of one repository
+    diff = run_git('-C', top_level, '-c', 'core.quotePath=false', 'diff', '-U0', '--no-color', '--no-ext-diff',
+                   '--src-prefix=a/', '--dst-prefix=b/', '--diff-filter=d', revision_range, '--')
+    changed_lines = {}
+    lines = None
+    in_header = False
+    for line in diff.split(b'\n'):
+        if line.startswith(b'diff --git '):
+            in_header = True
+            lines = None
+        elif in_header and line.startswith(b'+++ '):
+            name = line[4:].rstrip(b'\t')  # git ends names with spaces by a tab
+            if name.startswith(b'"'):
+                name = codecs.escape_decode(name[1:-1])[0]
+            if name.startswith(b'b/'):
+                lines = changed_lines.setdefault(os.path.join(top_level, os.fsdecode(name[2:])), [])
+        elif line.startswith(b'@@ '):
+            in_header = False
+            match = git_hunk_regex.match(line)
+            if match is not None and lines is not None:
+                start, count = int(match.group(1)), int(match.group(2) or 1)
+                if count:
+                    lines.append((start - 1, start + count - 2))
+    return {file: lines for file, lines in changed_lines.items() if lines}
+
+
+def discover_changed_files(paths: Iterable[str], changed_files: Iterable[str], *, include: Sequence[str] = (),
+                           exclude: Sequence[str] = (), extensions: Sequence[str] = (), cpp_only: bool = False,
+                           follow_links: bool = False, in_working_tree: bool = True,
+                           verbose_stderr: bool = False) -> Iterator[str]:
+    # the files `discover_files` would yield for `paths` that are among `changed_files` (real paths), found
+    # without walking the dirs; the filters apply to files in dirs the same way (git does not track files
+    # behind symbolic links to dirs, so `follow_links` changes nothing). Without `in_working_tree` the files
+    # are read from a revision (see `git_show`) and are not looked for in the working tree
+    extensions = tuple('.' + extension.lstrip('.') for extension in extensions)
+    changed_set = set(changed_files)
+    changed_files = sorted(changed_set)
+    for path in paths:
+        path = os.path.normpath(path)
+        real_path = os.path.realpath(path)
+        if os.path.isfile(path) or (not in_working_tree and real_path in changed_set):
+            if real_path in changed_set:
+                yield path
+            continue
+        if not os.path.isdir(path):
+            if verbose_stderr:
+                print(f'Object {path} is not dir or file, skipped', file=sys.stderr)
+            continue
+        for changed_file in changed_files[bisect.bisect_left(changed_files, real_path + os.sep):]:
+            if not changed_file.startswith(real_path + os.sep):
+                break
+            parts = os.path.relpath(changed_file, real_path).split(os.sep)
+            file = os.path.join(path, *parts)
+            name = parts[-1]
+            if any(glob_matches(part, os.path.join(*parts[:i + 1]), exclude) for i, part in enumerate(parts)) or \
+                    (include and not glob_matches(name, os.path.join(*parts), include)) or \
+                    (extensions and not name.endswith(extensions)) or (cpp_only and not cpp_filename_regex.match(name)):
+                continue
+            if not in_working_tree:
+                yield file
+                continue
+            try:
+                file_stat = os.stat(file)
+            except OSError:
+                if verbose_stderr:
+                    print(f'File {file} cannot be open for reading, skipped', file=sys.stderr)
+                continue
+            if not stat.S_ISREG(file_stat.st_mode):
+                if verbose_stderr:
+                    print(f'File {file} is not a regular file, skipped', file=sys.stderr)
+            elif file_stat.st_size > 0:
+                yield file
+            elif verbose_stderr:
+                print(f'File {file} is empty, skipped', file=sys.stderr)
+
+
+# ========================================== SERVER ==========================================
+
+@functools.lru_cache(maxsize=256)
+def compile_regex(regex_string: str, flags: int, engine: Literal['re', 're2'] = 're') -> Union[re.Pattern, LinearRegex]:
+    # `re2` falls back to `re` for patterns that need backtracking
+    regex_string = unicodedata.normalize(unicode_normalization_method, regex_string)
+    if not regex_string:
+        raise re.error('')
+    regex = re.compile(regex_string, flags)
+    if engine == 're2':
+        return LinearRegex.compile(regex_string, flags) or regex
+    return regex
+
+
+class SearchServer:
+    # Keeps read files with their lexer spans and nesting scopes in memory and answers queries given as
+    # JSON objects, one per line, over stdio or a Unix socket:
+    #   {"id": 1, "mode": "nesting", "text": "unload()", "flags": "i", "ignore_comments": true}
+    #   -> {"id": 1, "output": "...", "errors": "...", "files": 328, "time": 0.004}
+    # `regex` may be given instead of `text`, `{"command": "stats"}` and `{"command": "shutdown"}` are
+    # supported too. The files are discovered again and their `stat` compared with the loaded ones at most
+    # every `poll_interval` seconds; changed files are reloaded on use. Least recently used files are dropped
+    # when the estimated memory use exceeds `memory_budget` bytes. A request that cannot be answered gets
+    # `{"id": ..., "error": "..."}`, the server keeps running.
+    string_fields = ('command', 'text', 'regex', 'flags', 'mode', 'format')
+
+    def __init__(self, paths: Sequence[str], discover_options: Dict[str, Any], *, memory_budget: int,
+                 poll_interval: float = 1.0, search_binary: bool = False,
+                 cache: Optional[AnalysisCache] = None, verbose: bool = False):
+        self.paths = paths
+        self.discover_options = discover_options
+        self.memory_budget = memory_budget
+        self.poll_interval = poll_interval
+        self.search_binary = search_binary
+        self.cache = cache
+        self.verbose = verbose
+        self.files = []
+        self.file_stats = {}
+        self.entries = collections.OrderedDict()  # file -> (stat key, analysis or None for binary files, size)
+        self.memory_used = 0
+        self.last_poll = None
+        self.discovery_errors = ''
+
+    @classmethod
+    def estimate_size(cls, analysis: FileAnalysis) -> int:
+        scopes = analysis['scopes']
+        return (sys.getsizeof(analysis['file_content']) + 80 * len(analysis['spans'] or ()) +
+                (64 * len(scopes[0]) if scopes is not None else 0))
+
+    def poll(self):
+        now = time.monotonic()
+        if self.last_poll is not None and now - self.last_poll < self.poll_interval:
+            return
+        self.last_poll = now
+        files = []
+        file_stats = {}
+        for file in discover_files(self.paths, **self.discover_options):
+            try:
+                file_stat = os.stat(file)
+            except OSError:
+                continue
+            files.append(file)
+            file_stats[file] = (file_stat.st_size, file_stat.st_mtime_ns)
+        for file in list(self.entries):
+            if file_stats.get(file) != self.entries[file][0]:
+                self.drop(file)
+        self.files = files
+        self.file_stats = file_stats
+
+    def drop(self, file: str):
+        _, _, size = self.entries.pop(file)
+        self.memory_used -= size
+
+    def analysis(self, file: str) -> Optional[FileAnalysis]:
+        entry = self.entries.get(file)
+        if entry is not None:
+            self.entries.move_to_end(file)
+            return entry[1]
+        analysis = read_file(file, None, self.search_binary, self.cache)
+        if analysis is not None:
+            if analysis['spans'] is None:
+                analysis['spans'] = CppBaseMethods.tokenize(analysis['file_content'])
+            if analysis['scopes'] is None and cpp_filename_regex.match(file):
+                analysis['scopes'] = CppBaseMethods.determine_scopes(
+                    CppBaseMethods.mask(analysis['file_content'], analysis['spans'], int(TokenKind.ALL)))
+                if self.cache is not None and analysis['cache_key'] is not None:
+                    self.cache.store(file, analysis['cache_key'],
+                                     None if analysis['is_ascii'] else analysis['file_content'],
+                                     analysis['spans'], analysis['scopes'])
+        size = self.estimate_size(analysis) if analysis is not None else 0
+        self.entries[file] = (self.file_stats.get(file), analysis, size)
+        self.memory_used += size
+        while self.memory_used > self.memory_budget and len(self.entries) > 1:
+            self.drop(next(iter(self.entries)))
+        return analysis
+
+    def query(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        time_start = time.monotonic()
+        response = {'id': request.get('id')}
+        for field in self.string_fields:
+            if field in request and not isinstance(request[field], str):
+                response['error'] = f'field {field!r} must be a string'
+                return response
+        command = request.get('command', 'search')
+        if command == 'stats':
+            self.poll()
+            response.update(files=len(self.files), loaded=len(self.entries), memory_used=self.memory_used,
+                            memory_budget=self.memory_budget)
+            return response
+        if command != 'search':
+            response['error'] = f'unknown command: {command!r}'
+            return response
+
+        regex_string = re.escape(request['text']) if request.get('text') else request.get('regex', '')
+        try:
+            regex = compile_regex(regex_string, parse_flags(request.get('flags', '')))
+        except (re.error, TypeError):
+            response['error'] = f'regex is invalid: {regex_string!r}'
+            return response
+        mode = request.get('mode', 'simple')
+        mode = mode if mode in {'simple', 'nesting'} else 'simple'
+        output_format = request.get('format', 'text')
+        output_format = output_format if output_format in {'text', 'jsonl', 'tsv'} else 'text'
+        verbose = bool(request.get('verbose', self.verbose))
+        options = SearchOptions(mode=mode, regex=regex, regex_for_single_line_skip=None,
+                                regex_for_multi_line_skip=None,
+                                skip_kinds=CppBaseMethods.skip_kinds(
+                                    comments=bool(request.get('ignore_comments')),
+                                    directives=bool(request.get('ignore_directives')),
+                                    char_str_literals=bool(request.get('ignore_char_str_literals'))),
+                                prefilter=None, search_binary=self.search_binary, cache=None,
+                                output_format=output_format, snippet=bool(request.get('snippet', True)),
+                                stream_size=0, changed_lines=None, git_revision=None,
+                                verbose=verbose)
+        prefilter = LiteralPrefilter.from_regex(regex)
+
+        self.poll()
+        output = []
+        errors = []
+        for file in self.files:
+            try:
+                analysis = self.analysis(file)
+                if analysis is None:
+                    if verbose:
+                        errors.append(f'File {file} is binary, skipped\n')
+                    continue
+                if analysis['is_ascii'] and prefilter is not None and \
+                        not prefilter.may_match_text(analysis['file_content']):
+                    continue
+                output.append(search_analysis(file, analysis, options))
+            except Exception as e:
+                if verbose:
+                    errors.append(f'{file} {e}\n')
+        response.update(output=''.join(output), errors=''.join(errors), files=len(self.files),
+                        time=round(time.monotonic() - time_start, 6))
+        return response
+
+    def handle_line(self, line: str) -> Optional[str]:
+        line = line.strip()
+        if not line:
+            return None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request must be a JSON object')
+        except ValueError as e:
+            return json.dumps({'id': None, 'error': f'invalid request: {e}'})
+        try:
+            return json.dumps(self.query(request))
+        except Exception as e:
+            return json.dumps({'id': request.get('id'), 'error': f'request failed: {e!r}'})
+
+    @classmethod
+    def is_shutdown(cls, line: str) -> bool:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return False
+        return isinstance(request, dict) and request.get('command') == 'shutdown'
+
+    def serve_stdio(self, stdin: TextIO = sys.stdin, stdout: TextIO = sys.stdout):
+        for line in stdin:
+            if self.is_shutdown(line):
+                break
+            response = self.handle_line(line)
+            if response is not None:
+                stdout.write(response + '\n')
+                stdout.flush()
+
+    def serve_socket(self, socket_path: str):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(socket_path)
+            server.listen()
+            try:
+                while True:
+                    connection, _ = server.accept()
+                    with connection, connection.makefile('r', encoding='utf-8') as reader, \
+                            connection.makefile('w', encoding='utf-8') as writer:
+                        for line in reader:
+                            if self.is_shutdown(line):
+                                return
+                            response = self.handle_line(line)
+                            if response is not None:
+                                writer.write(response + '\n')
+                                writer.flush()
+            finally:
+                os.remove(socket_path)
+
 
 # ========================================== MAIN ==========================================
 
@@ -255,26 +2457,101 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument("-m", "--mode", type=str, default='simple', required=False,
                         help="app mode:\n"
                              "`simple` - search for occurrences (default)\n"
-                             "`nesting` - search for occurrences with nesting")
+                             "`nesting` - search for occurrences with nesting\n"
+                             "`index` - build or update the trigram index of paths (see `--index`)\n"
+                             "`serve` - keep paths in memory and answer JSON queries (see `--socket`)")
     parser.add_argument("-p", "--paths", type=str, default=[], required=True, nargs='+',
                         help="paths to dirs/files [example: `/path/to/dir /path/to/file`]")
-    x_group_2 = parser.add_mutually_exclusive_group(required=True)
-    x_group_2.add_argument("-t", "--text", type=str, default='',
-                           help="plain text for search [example: `ab`]")
-    x_group_2.add_argument("-r", "--regex", type=str, default='',
-                           help="python-regex for search [example: `\"a.*?b\"`]")
+    x_group_2 = parser.add_mutually_exclusive_group(required=False)
+    x_group_2.add_argument("-t", "--text", type=str, default=None, nargs='+',
+                           help="plain text for search, several texts are searched in one pass and\n"
+                                "tagged by number [example: `ab`]")
+    x_group_2.add_argument("-r", "--regex", type=str, default=None, nargs='+',
+                           help="python-regex for search, several regexes are searched in one pass and\n"
+                                "tagged by number [example: `\"a.*?b\"`]")
+    x_group_2.add_argument("-pf", "--pattern-file", type=str, default=None,
+                           help="file of python-regexes searched in one pass, one per line (`ID<tab>regex`\n"
+                                "or `regex` tagged by number, empty lines and `#` lines are skipped)")
     parser.add_argument('-f', '--flags', type=str, default='', required=False,
                         help="flags:\nA (ASCII-only matching),\nI (ignore case),\nL (locale dependent),\n"
                              "M (multi-line),\nS (dot matches all),\nU (Unicode matching)\n"
                              "[example: `AILMSU` or `ailmsu`]")
+    parser.add_argument('-e', '--engine', type=str, default='re', required=False,
+                        help="regex engine for the text/regex patterns:\n"
+                             "`re` - python-regex (default)\n"
+                             "`re2` - linear-time matching with the optional `google-re2` package, patterns\n"
+                             "with backreferences, lookarounds or atomic groups fall back to `re`")
+    parser.add_argument('-in', '--include', type=str, default=[], required=False, nargs='+',
+                        help="search only files in dirs whose name or path in the searched dir matches one of\n"
+                             "the globs [example: `'*.cpp' 'src/*'`]")
+    parser.add_argument('-ex', '--exclude', type=str, default=[], required=False, nargs='+',
+                        help="skip files and dirs whose name or path in the searched dir matches one of the\n"
+                             "globs [example: `'*_test.cpp' build .git`]")
+    parser.add_argument('-ext', '--extensions', type=str, default=[], required=False, nargs='+',
+                        help="search only files in dirs with one of the extensions [example: `cpp .h`]")
+    parser.add_argument('-gr', '--git-range', type=str, default='', required=False,
+                        help="search only files changed in a git revision range of the repositories of the paths\n"
+                             "and report only matches on added/changed lines (scopes are taken from the whole\n"
+                             "files, read from the last revision of the range, or from the working tree if it\n"
+                             "is a single revision) [example: `origin/main...HEAD`]")
+    parser.add_argument('-co', '--cpp-only', action='store_true', required=False,
+                        help='Search only C++ files in dirs')
+    parser.add_argument('-fl', '--follow-links', action='store_true', required=False,
+                        help='Follow symbolic links to dirs (symbolic link loops are skipped)')
+    parser.add_argument('-b', '--binary', action='store_true', required=False,
+                        help='Search binary files too (files with a NUL byte at the start)')
     parser.add_argument('-ic', '--ignore-comments', action='store_true', required=False,
                         help='Ignore comments')
     parser.add_argument('-id', '--ignore-directives', action='store_true', required=False,
                         help='Ignore preprocessing directives')
     parser.add_argument('-icsl', '--ignore-char-str-literals', action='store_true', required=False,
                         help='Ignore char and string literals')
+    parser.add_argument('-l', '--lexer', type=str, default='single-pass', required=False,
+                        help="lexer for comments, directives and literals:\n"
+                             "`single-pass` - one linear pass per file (default)\n"
+                             "`regex` - regular expressions (legacy)")
+    parser.add_argument('-fo', '--format', type=str, default='text', required=False,
+                        help="output format:\n"
+                             "`text` - locations and lines for reading (default)\n"
+                             "`jsonl` - a JSON object per match with offsets, lines, columns and scopes\n"
+                             "`tsv` - a tab-separated line per match\n"
+                             "(`jsonl` and `tsv` require the `single-pass` lexer)")
+    parser.add_argument('-nsn', '--no-snippet', action='store_true', required=False,
+                        help='Do not slice matched lines and scope headers into `jsonl`/`tsv` records')
+    parser.add_argument('-ss', '--stream-size', type=int, default=256, required=False,
+                        help="files of at least this many MiB are searched in windows of bounded memory\n"
+                             "(`text` format and `single-pass` lexer), 0 - never (default: 256)")
+    parser.add_argument('-cd', '--cache-dir', type=str, default='', required=False,
+                        help="dir of the persistent cache of normalized contents, lexer spans and scopes\n"
+                             "(`single-pass` lexer only) [example: `~/.cache/cpp-searcher`]")
+    parser.add_argument('-cs', '--cache-size', type=int, default=512, required=False,
+                        help='max size of the cache in MiB, least recently used files are evicted (default: 512)')
+    parser.add_argument('-ix', '--index', type=str, default='', required=False,
+                        help="trigram index file: written by `index` mode, used by the other modes to open\n"
+                             "only files that may contain the literals of the text/regex [example: `src.idx`]")
+    parser.add_argument('-so', '--socket', type=str, default='', required=False,
+                        help="`serve` mode: Unix socket to listen on instead of stdin/stdout")
+    parser.add_argument('-mb', '--memory-budget', type=int, default=1024, required=False,
+                        help='`serve` mode: memory for files in MiB, least recently used files are dropped '
+                             '(default: 1024)')
+    parser.add_argument('-pi', '--poll-interval', type=float, default=1.0, required=False,
+                        help='`serve` mode: min seconds between checks of files for changes (default: 1)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, required=False,
+                        help='number of processes searching files in parallel, 0 - one per CPU (default: 1)')
+    parser.add_argument('-fb', '--file-budget', type=float, default=0.0, required=False,
+                        help="seconds a file may take, slower files are abandoned and reported, 0 - no limit\n"
+                             "(default: 0)")
+    parser.add_argument('-qb', '--query-budget', type=float, default=0.0, required=False,
+                        help="seconds the whole search may take, the files left are not searched and\n"
+                             "reported, 0 - no limit (default: 0)")
     parser.add_argument('-mt', '--measure-time', action='store_true', required=False,
                         help='Measure program runtime')
+    parser.add_argument('-pr', '--profile', type=str, default='', const='table', nargs='?', required=False,
+                        help="print per-phase times, counters and the slowest files to stderr\n"
+                             "as a `table` (default) or `json`, the search runs in one process\n"
+                             "without time budgets")
+    parser.add_argument('-pt', '--profile-top', type=int, default=10, required=False,
+                        help='number of the slowest files reported by `--profile` (default: 10)')
     parser.add_argument('-v', '--verbose', action='store_true', required=False, help='Verbose mode')
     parser.add_argument('--debug-args', action='store_true', required=False, help='Debug mode '
                                                                                   '(only shows converted arguments)')
@@ -282,154 +2559,352 @@ def get_parser() -> argparse.ArgumentParser:
 
 
 class ParserArguments(TypedDict):
-    mode: Literal['simple', 'nesting']
-    paths: List[str]
-    regex_string: str
+    mode: Literal['simple', 'nesting', 'index', 'serve']
+    paths: Iterator[str]
+    search_paths: List[str]
+    discover_options: Dict[str, Any]
+    git_range: str
+    changed_lines: Optional[Dict[str, List[Tuple[int, int]]]]
+    git_revision: Optional[str]
+    patterns: List[Tuple[str, str]]
+    tag_patterns: bool  # tag matches by pattern ID even if there is one pattern (patterns of a pattern file)
     flags: int
+    engine: Literal['re', 're2']
     ignore_comments: bool
     ignore_directives: bool
     ignore_char_str_literals: bool
+    lexer: Literal['single-pass', 'regex']
+    output_format: Literal['text', 'jsonl', 'tsv']
+    snippet: bool
+    stream_size: int
+    binary: bool
+    cache_dir: str
+    cache_size: int
+    index: str
+    socket: str
+    memory_budget: int
+    poll_interval: float
+    jobs: int
+    file_budget: float
+    query_budget: float
     measure_time: bool
+    profile: Literal['', 'table', 'json']
+    profile_top: int
     verbose: bool
     debug_args: bool
 
 
+def parse_flags(flags: str) -> int:
+    flags = flags.upper()
+    return int((bool('A' in flags) * re.A) | (bool('I' in flags) * re.I) | (bool('L' in flags) * re.L) |
+               (bool('M' in flags) * re.M) | (bool('S' in flags) * re.S) | (bool('U' in flags) * re.U))
+
+
+def parse_pattern_file(pattern_file: str) -> List[Tuple[str, str]]:
+    patterns = []
+    with open(pattern_file, 'r') as fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            pattern_id, tab, regex_string = line.partition('\t')
+            if not tab:
+                pattern_id, regex_string = str(1 + len(patterns)), line
+            patterns.append((pattern_id, regex_string))
+    return patterns
+
+
 def parse_arguments(parser: argparse.ArgumentParser, *, verbose_stderr: bool) -> Union[int, ParserArguments]:
     try:
         args = parser.parse_args()
     except:
         return 1
 
-    mode = args.mode if args.mode in {'simple', 'nesting'} else 'simple'
+    mode = args.mode if args.mode in {'simple', 'nesting', 'index', 'serve'} else 'simple'
+    if mode in {'simple', 'nesting'} and args.text is None and args.regex is None and args.pattern_file is None:
+        parser.print_usage(sys.stderr)
+        print(f'{parser.prog}: error: one of the arguments -t/--text -r/--regex -pf/--pattern-file is required',
+              file=sys.stderr)
+        return 1
+    if mode == 'index' and not args.index:
+        parser.print_usage(sys.stderr)
+        print(f'{parser.prog}: error: `index` mode requires the argument -ix/--index', file=sys.stderr)
+        return 1
     debug_args = bool(args.debug_args)
     verbose = bool(args.verbose)
     ignore_comments = bool(args.ignore_comments)
     ignore_directives = bool(args.ignore_directives)
     ignore_char_str_literals = bool(args.ignore_char_str_literals)
+    lexer = args.lexer if args.lexer in {'single-pass', 'regex'} else 'single-pass'
+    output_format = args.format if args.format in {'text', 'jsonl', 'tsv'} else 'text'
+    if output_format != 'text' and lexer == 'regex':
+        parser.print_usage(sys.stderr)
+        print(f'{parser.prog}: error: -fo/--format {output_format} requires the `single-pass` lexer', file=sys.stderr)
+        return 1
+    engine = args.engine if args.engine in {'re', 're2'} else 're'
+    if engine == 're2' and re2 is None:
+        parser.print_usage(sys.stderr)
+        print(f'{parser.prog}: error: -e/--engine re2 requires the `google-re2` package', file=sys.stderr)
+        return 1
+    snippet = not args.no_snippet
+    stream_size = max(0, args.stream_size)
+    binary = bool(args.binary)
+    cache_dir = os.path.expanduser(args.cache_dir) if args.cache_dir else ''
+    cache_size = max(0, args.cache_size)
+    index = args.index
+    socket_path = args.socket
+    memory_budget = max(0, args.memory_budget)
+    poll_interval = max(0.0, args.poll_interval)
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    file_budget = max(0.0, args.file_budget)
+    query_budget = max(0.0, args.query_budget)
     measure_time = bool(args.measure_time)
+    profile = args.profile if args.profile in {'', 'table', 'json'} else 'table'
+    profile_top = max(0, args.profile_top)
 
-    files = []
-    for path in args.paths:
-        path = os.path.normpath(path)
-        if os.path.isdir(path):
-            for dirpath, dirnames, filenames in os.walk(top=path, topdown=True):
-                for filename in filenames:
-                    file_path = os.path.join(dirpath, filename)
-                    try:
-                        with open(file_path, 'r') as fp:
-                            fp.seek(0, 2)
-                            symbols = fp.tell()
-                        if symbols > 0:
-                            files.append(file_path)
-                        elif verbose_stderr:
-                            print(f'File {file_path} is empty, skipped', file=sys.stderr)
-                    except:
-                        if verbose_stderr:
-                            print(f'File {file_path} cannot be open for reading, skipped', file=sys.stderr)
-        elif os.path.isfile(path):
-            files.append(path)
-        elif verbose_stderr:
-            print(f'Object {path} is not dir or file, skipped', file=sys.stderr)
+    discover_options = dict(include=args.include, exclude=args.exclude, extensions=args.extensions,
+                            cpp_only=bool(args.cpp_only), follow_links=bool(args.follow_links),
+                            verbose_stderr=verbose_stderr)
+    git_range = args.git_range
+    changed_lines = None
+    git_revision = None
+    if git_range and mode in {'simple', 'nesting'}:
+        try:
+            diff = git_diff(git_range, args.paths)
+        except OSError as e:
+            print(f'Git range {git_range} cannot be used: {e}', file=sys.stderr)
+            return 2
+        git_revision = git_range_revision(git_range)
+        files = list(discover_changed_files(args.paths, diff, in_working_tree=git_revision is None,
+                                            **discover_options))
+        changed_lines = {file: diff[os.path.realpath(file)] for file in files}
+    else:
+        files = discover_files(args.paths, **discover_options)
 
-    flags = args.flags.upper()
-    flags = int((bool('A' in flags) * re.A) | (bool('I' in flags) * re.I) | (bool('L' in flags) * re.L) |
-                (bool('M' in flags) * re.M) | (bool('S' in flags) * re.S) | (bool('U' in flags) * re.U))
+    flags = parse_flags(args.flags)
 
-    regex_string = re.escape(args.text) if args.text else args.regex
-    return ParserArguments(mode=mode, paths=files, regex_string=regex_string,
-                           flags=flags, ignore_comments=ignore_comments,
-                           ignore_directives=ignore_directives, ignore_char_str_literals=ignore_char_str_literals,
-                           measure_time=measure_time, verbose=verbose, debug_args=debug_args)
+    if args.pattern_file is not None:
+        try:
+            patterns = parse_pattern_file(args.pattern_file)
+        except (OSError, UnicodeError) as e:
+            print(f'Pattern file {args.pattern_file} cannot be read: {e}', file=sys.stderr)
+            return 1
+    elif args.text is not None:
+        patterns = [(str(1 + i), re.escape(text)) for i, text in enumerate(args.text)]
+    else:
+        patterns = [(str(1 + i), regex_string) for i, regex_string in enumerate(args.regex or [''])]
+    return ParserArguments(mode=mode, paths=files, search_paths=args.paths, discover_options=discover_options,
+                           git_range=git_range, changed_lines=changed_lines, git_revision=git_revision,
+                           patterns=patterns, tag_patterns=args.pattern_file is not None, flags=flags,
+                           engine=engine, ignore_comments=ignore_comments, ignore_directives=ignore_directives,
+                           ignore_char_str_literals=ignore_char_str_literals,
+                           lexer=lexer, output_format=output_format, snippet=snippet, stream_size=stream_size,
+                           binary=binary, cache_dir=cache_dir, cache_size=cache_size, index=index,
+                           socket=socket_path, memory_budget=memory_budget, poll_interval=poll_interval,
+                           jobs=jobs, file_budget=file_budget, query_budget=query_budget,
+                           measure_time=measure_time, profile=profile, profile_top=profile_top,
+                           verbose=verbose, debug_args=debug_args)
 
 
 def main():
-    import time
-    unicode_normalization_method = "NFKD"
-
+    global profiler
     warnings.filterwarnings("error")
     dict_args = parse_arguments(get_parser(), verbose_stderr=True)
     if isinstance(dict_args, int):
         sys.exit(dict_args)
     mode = dict_args['mode']
-    mode = mode if mode in {'simple', 'nesting'} else 'simple'
+    mode = mode if mode in {'simple', 'nesting', 'index', 'serve'} else 'simple'
     files = dict_args['paths']
+    index = dict_args['index']
+    verbose = dict_args['verbose']
+    if mode == 'index' and not dict_args['debug_args']:
+        time_start = time.monotonic()
+        try:
+            files_count, indexed = TrigramIndex.update(index, files, verbose_stderr=verbose)
+        except OSError as e:
+            print(f'Index {index} cannot be written: {e}', file=sys.stderr)
+            sys.exit(1)
+        if dict_args['measure_time']:
+            print('Files:', files_count)
+            print('Indexed:', indexed)
+            print('Time:', round(time.monotonic() - time_start, 3), 'seconds')
+        return
+    if mode == 'serve' and not dict_args['debug_args']:
+        cache = None
+        if dict_args['cache_dir']:
+            try:
+                cache = AnalysisCache(dict_args['cache_dir'], dict_args['cache_size'] << 20)
+            except OSError as e:
+                print(f'Cache dir {dict_args["cache_dir"]} cannot be used: {e}', file=sys.stderr)
+        discover_options = dict(dict_args['discover_options'], verbose_stderr=verbose)
+        server = SearchServer(dict_args['search_paths'], discover_options,
+                              memory_budget=dict_args['memory_budget'] << 20,
+                              poll_interval=dict_args['poll_interval'], search_binary=dict_args['binary'],
+                              cache=cache, verbose=verbose)
+        if dict_args['socket']:
+            server.serve_socket(dict_args['socket'])
+        else:
+            server.serve_stdio()
+        return
     flags = dict_args['flags']
+    engine = dict_args['engine']
     ignore_comments = dict_args['ignore_comments']
     ignore_directives = dict_args['ignore_directives']
     ignore_char_str_literals = dict_args['ignore_char_str_literals']
+    lexer = dict_args['lexer']
+    output_format = dict_args['output_format']
+    snippet = dict_args['snippet']
+    stream_size = dict_args['stream_size']
+    binary = dict_args['binary']
+    cache_dir = dict_args['cache_dir']
+    cache_size = dict_args['cache_size']
+    jobs = dict_args['jobs']
+    file_budget = dict_args['file_budget']
+    query_budget = dict_args['query_budget']
     measure_time = dict_args['measure_time']
-    regex_string = unicodedata.normalize(unicode_normalization_method, dict_args['regex_string'])
-    try:
-        if not regex_string:
-            raise re.error('')
-        regex = re.compile(regex_string, flags)
-    except re.error:
-        print(f'regex is invalid: {repr(dict_args["regex_string"])}', file=sys.stderr)
-        sys.exit(2)
-    verbose = dict_args['verbose']
+    profile = dict_args['profile']
+    regexes = []
+    if mode not in {'index', 'serve'}:
+        for pattern_id, regex_string in dict_args['patterns']:
+            try:
+                regexes.append((pattern_id, compile_regex(regex_string, flags, engine)))
+            except re.error:
+                print(f'regex is invalid: {repr(regex_string)}', file=sys.stderr)
+                sys.exit(2)
+        if not regexes:
+            print('no patterns to search for', file=sys.stderr)
+            sys.exit(2)
+    regex = None
+    if len(regexes) == 1 and not dict_args['tag_patterns']:
+        regex = regexes[0][1]
+    elif regexes:
+        regex = PatternSet(regexes)
     debug_args = dict_args['debug_args']
     if debug_args:
+        files = list(files)
         print(f'mode: {mode}\n'
               f'files: ' + " ".join(f"\"{file}\"" for file in files) + '\n' +
               f'regex: {regex}\n'
               f'flags: {flags or "-"}\n'
+              f'engine: {engine}\n'
               f'ignore_comments: {ignore_comments}\n'
               f'ignore_directives: {ignore_directives}\n'
               f'ignore_char_str_literals: {ignore_char_str_literals}\n'
+              f'git_range: {dict_args["git_range"] or "-"}\n'
+              f'lexer: {lexer}\n'
+              f'format: {output_format}\n'
+              f'snippet: {snippet}\n'
+              f'stream_size: {stream_size}\n'
+              f'binary: {binary}\n'
+              f'cache_dir: {cache_dir or "-"}\n'
+              f'cache_size: {cache_size}\n'
+              f'index: {index or "-"}\n'
+              f'jobs: {jobs}\n'
+              f'file_budget: {file_budget or "-"}\n'
+              f'query_budget: {query_budget or "-"}\n'
               f'measure_time: {measure_time}\n'
+              f'profile: {profile or "-"}\n'
               f'verbose: {verbose}\n'
               f'debug_args: {debug_args}',
               file=sys.stderr)
         sys.exit(0)
 
-    normalize_string_regex = re.compile(r'\s+')
-
     # main process
-    indent = ' ' * 4
     if measure_time:
         time_start = time.monotonic()
-    regex_for_single_line_skip = CppBaseMethods.generate_regex_for_single_line_skip(
-        single_line_comments=ignore_comments
-    )
-    regex_for_multi_line_skip = CppBaseMethods.generate_regex_for_multi_line_skip(
-        multi_line_comments=ignore_comments,
-        preprocessor_directives=ignore_directives,
-        char_literals=ignore_char_str_literals,
-        string_literals=ignore_char_str_literals)
-    cpp_filename_regex = re.compile(r'^.*(?:\.cc|\.cpp|\.cxx|\.c|\.c\+\+|\.h|\.hpp|\.hh|\.hxx|\.h\+\+)$', re.MULTILINE)
-    for file in files:
+    if profile:
+        profiler = Profiler(dict_args['profile_top'])
+        files = profiler.iterate('discover', files)
+        jobs = 1
+    if lexer == 'regex':
+        skip_kinds = None
+        regex_for_single_line_skip = CppBaseMethods.generate_regex_for_single_line_skip(
+            single_line_comments=ignore_comments
+        )
+        regex_for_multi_line_skip = CppBaseMethods.generate_regex_for_multi_line_skip(
+            multi_line_comments=ignore_comments,
+            preprocessor_directives=ignore_directives,
+            char_literals=ignore_char_str_literals,
+            string_literals=ignore_char_str_literals)
+    else:
+        skip_kinds = CppBaseMethods.skip_kinds(comments=ignore_comments,
+                                               directives=ignore_directives,
+                                               char_str_literals=ignore_char_str_literals)
+        regex_for_single_line_skip = regex_for_multi_line_skip = None
+    cache = None
+    if cache_dir and skip_kinds is not None:
         try:
-            with open(file, 'r') as fp:
-                file_content = unicodedata.normalize(unicode_normalization_method, fp.read())
-                if mode == 'nesting' and cpp_filename_regex.match(file):
-                    result = []
-                    for trace in CppBaseMethods.nesting_mode_search(regex, file_content,
-                                                                    regex_for_single_line_skip,
-                                                                    regex_for_multi_line_skip):
-                        str_trace_list = []
-                        for s, p in trace:
-                            s = repr(normalize_string_regex.sub(' ', s.strip()))[1:-1]
-                            str_trace_list.append(f"{file}:{p}\n{indent + s}")
-                        if str_trace_list:
-                            result.append('\n'.join(str_trace_list))
-                    if result:
-                        print('\n\n'.join(result), end='\n\n')
-                else:  # 'simple'
-                    result = []
-                    for s, p in CppBaseMethods.simple_mode_search(regex, file_content,
-                                                                  regex_for_single_line_skip,
-                                                                  regex_for_multi_line_skip):
-                        s = repr(normalize_string_regex.sub(' ', s.strip()))[1:-1]
-                        result.append(f"{file}:{p}\n{indent + s}")
-                    if result:
-                        print('\n'.join(result), end='\n\n')
-        except BaseException as e:
+            cache = AnalysisCache(cache_dir, cache_size << 20)
+        except OSError as e:
+            print(f'Cache dir {cache_dir} cannot be used: {e}', file=sys.stderr)
+    options = SearchOptions(mode=mode, regex=regex,
+                            regex_for_single_line_skip=regex_for_single_line_skip,
+                            regex_for_multi_line_skip=regex_for_multi_line_skip,
+                            skip_kinds=skip_kinds,
+                            prefilter=regex.prefilter() if isinstance(regex, PatternSet) else
+                            LiteralPrefilter.from_regex(regex),
+                            search_binary=binary, cache=cache, output_format=output_format, snippet=snippet,
+                            stream_size=stream_size << 20, changed_lines=dict_args['changed_lines'],
+                            git_revision=dict_args['git_revision'], verbose=verbose)
+    files_count = 0
+
+    def counted(files: Iterable[str]) -> Iterator[str]:
+        nonlocal files_count
+        for file in files:
+            files_count += 1
+            yield file
+
+    files = counted(files)
+    if index and options['git_revision'] is None:  # the index is of the working tree
+        try:
+            file_filter = TrigramIndex.load(index).file_filter(regex)
+        except (OSError, ValueError, struct.error) as e:
+            file_filter = None
             if verbose:
-                print(file, e, file=sys.stderr)
+                print(f'Index {index} cannot be used: {e}', file=sys.stderr)
+        if file_filter is not None:
+            files = filter(file_filter, files)
+        elif verbose:
+            print(f'Index {index} cannot shortlist files for this regex, all files are searched', file=sys.stderr)
+
+    stdout = sys.stdout
+    if output_format != 'text':
+        # records are written through a large buffer; the text output keeps the interleaving with stderr
+        stdout = open(sys.stdout.fileno(), 'w', buffering=1 << 20, encoding=sys.stdout.encoding,
+                      errors=sys.stdout.errors, closefd=False)
+    skipped = []
+    if (file_budget or query_budget) and profiler is None:
+        results = search_files_budgeted(files, options, jobs=jobs, file_budget=file_budget,
+                                        query_budget=query_budget, skipped=skipped)
+    else:
+        results = search_files(files, options, jobs=jobs)
+    try:
+        for output, errors in results:
+            if profiler is not None:
+                output_time_start = time.perf_counter()
+            if output:
+                stdout.write(output)
+            if errors:
+                sys.stderr.write(errors)
+            if profiler is not None:
+                profiler.add('output', output_time_start)
+    finally:
+        # the records already written reach stdout even if the search is interrupted
+        if stdout is not sys.stdout:
+            stdout.close()
+    if skipped:
+        sys.stdout.flush()
+        sys.stderr.write(f'Files skipped by the time budgets: {len(skipped)}\n' +
+                         ''.join(f'  {file}: {reason}\n' for file, reason in skipped))
+    if cache is not None:
+        cache.evict()
     if measure_time:
         time_stop = time.monotonic()
-        print('Files:', len(files))
+        print('Files:', files_count)
         print('Time:', round(time_stop - time_start, 3), 'seconds')
+    if profiler is not None:
+        sys.stdout.flush()
+        sys.stderr.write(profiler.report(profile))
 
 
 if __name__ == "__main__":
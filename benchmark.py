@@ -0,0 +1,392 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from typing import *
+
+from app import BaseMethods, CppBaseMethods, LineIndex, SearchOptions, TokenKind, read_file, search_files
+
+
+# ========================================== CORPUS ==========================================
+
+def generate_line_index_file(lines: int = 50000, matches: int = 10000) -> str:
+    step = max(1, lines // matches)
+    content = []
+    for i in range(lines):
+        if i % step == 0 and i // step < matches:
+            content.append(f'    value_{i} = item.second->unload();')
+        else:
+            content.append(f'    value_{i} = compute({i}, {i + 1});')
+    return '\n'.join(content) + '\n'
+
+
+def generate_namespace_file(functions: int = 2000) -> str:
+    content = ['namespace big {']
+    for i in range(functions):
+        content.append(f'    int function_{i}(int x) {{\n'
+                       f'        if (x > {i}) {{\n'
+                       f'            return item.second->unload(x);\n'
+                       f'        }}\n'
+                       f'        return 0;\n'
+                       f'    }}')
+    content.append('}')
+    return '\n'.join(content) + '\n'
+
+
+class CorpusOptions(TypedDict):
+    files: int
+    functions: int
+    depth: int
+    comment_density: float
+    literal_density: float
+    match_density: float
+    huge_namespace: int
+    raw_strings: int
+    seed: int
+
+
+def generate_statement(rng: random.Random, options: CorpusOptions, indent: str) -> List[str]:
+    # one statement, sometimes preceded by a comment and sometimes holding literals with brackets and quotes,
+    # so that masking changes both the scopes and the matches
+    lines = []
+    if rng.random() < options['comment_density']:
+        if rng.random() < 0.5:
+            lines.append(f'{indent}// note {rng.randrange(1000)}: {{ not a scope, unload() }}')
+        else:
+            lines.append(f'{indent}/* block {rng.randrange(1000)} {{')
+            lines.append(f'{indent}   item.second->unload(); }} */')
+    if rng.random() < options['match_density']:
+        lines.append(f'{indent}item.second->unload();')
+    elif rng.random() < options['literal_density']:
+        lines.append(f'{indent}log("{{ unload() \\" }}", \'{{\', u8"\\n}}");')
+    else:
+        lines.append(f'{indent}value_{rng.randrange(100)} = compute({rng.randrange(100)}, x);')
+    return lines
+
+
+def generate_block(rng: random.Random, options: CorpusOptions, depth: int, indent: str) -> List[str]:
+    lines = []
+    for _ in range(rng.randint(1, 3)):
+        lines.extend(generate_statement(rng, options, indent))
+    if depth > 0:
+        header = rng.choice(['for (int i = 0; i < n; ++i) {', 'if (x > 0) {', 'while (ready()) {',
+                             'switch (x) {', 'do {'])
+        lines.append(indent + header)
+        lines.extend(generate_block(rng, options, depth - 1, indent + '    '))
+        lines.append(indent + ('} while (false);' if header == 'do {' else '}'))
+        lines.extend(generate_statement(rng, options, indent))
+    return lines
+
+
+def generate_cpp_file(rng: random.Random, options: CorpusOptions, name: str) -> str:
+    lines = [f'// {name}', '#include <vector>', '#define GUARD(x) { \\', '    if (!(x)) return; }', '',
+             f'namespace {name} {{', f'class Widget_{name} {{', 'public:']
+    for i in range(options['functions']):
+        lines.append(f'    int function_{i}(int x) {{')
+        lines.extend(generate_block(rng, options, rng.randint(0, options['depth']), ' ' * 8))
+        lines.append('        return 0;')
+        lines.append('    }')
+    lines.extend(['};', '}', ''])
+    return '\n'.join(lines)
+
+
+def generate_raw_string_file(strings: int = 200, lines: int = 200) -> str:
+    content = []
+    for i in range(strings):
+        body = '\n'.join(f'    {{ "unload()" /* {j} */ }}' for j in range(lines))
+        content.append(f'const char* raw_{i} = R"xy({body}\n)" still raw )xy";')
+        content.append(f'void use_{i}() {{ item.second->unload(); }}')
+    return '\n'.join(content) + '\n'
+
+
+def generate_corpus(corpus_dir: str, options: CorpusOptions) -> List[str]:
+    # Writes a deterministic C++ tree (the same options and seed always give the same bytes): `files` sources
+    # in dirs of 50 plus the pathological `huge_namespace.cpp` and `raw_strings.cpp` when their sizes are not 0.
+    rng = random.Random(options['seed'])
+    files = []
+    for i in range(options['files']):
+        dir_path = os.path.join(corpus_dir, f'dir_{i // 50}')
+        os.makedirs(dir_path, exist_ok=True)
+        files.append((os.path.join(dir_path, f'file_{i}' + ('.h' if i % 4 == 3 else '.cpp')),
+                      generate_cpp_file(rng, options, f'module_{i}')))
+    if options['huge_namespace']:
+        files.append((os.path.join(corpus_dir, 'huge_namespace.cpp'),
+                      generate_namespace_file(options['huge_namespace'])))
+    if options['raw_strings']:
+        files.append((os.path.join(corpus_dir, 'raw_strings.cpp'),
+                      generate_raw_string_file(options['raw_strings'])))
+    for file, content in files:
+        with open(file, 'w', newline='\n') as fp:
+            fp.write(content)
+    return [file for file, _ in files]
+
+
+# ========================================== BENCHMARKS ==========================================
+
+def best_time(function: Callable[[], Any], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - time_start)
+    return min(times)
+
+
+def bench_line_index(lines: int = 50000, matches: int = 10000) -> Dict[str, float]:
+    file_content = generate_line_index_file(lines, matches)
+    regex = re.compile(re.escape('unload'))
+    spans = [match.span(0) for match in regex.finditer(file_content)]
+
+    time_start = time.perf_counter()
+    for abs_start, abs_end in spans:
+        file_content.count('\n', 0, abs_start)
+        file_content.count('\n', 0, abs_end)
+        file_content.rfind('\n', 0, abs_start)
+        file_content.rfind('\n', 0, abs_end)
+        file_content.find('\n', abs_start, len(file_content))
+        file_content.find('\n', abs_end, len(file_content))
+    rescan_time = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    line_index = LineIndex(file_content)
+    for abs_start, abs_end in spans:
+        BaseMethods.determine_occurrence(file_content, abs_start, abs_end, line_index)
+    indexed_time = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    CppBaseMethods.simple_mode_search(regex, file_content)
+    simple_mode_time = time.perf_counter() - time_start
+
+    return {'lines': lines, 'matches': len(spans), 'rescan': rescan_time,
+            'line_index': indexed_time, 'simple_mode_search': simple_mode_time}
+
+
+def bench_nesting(functions: int = 2000) -> Dict[str, float]:
+    file_content = generate_namespace_file(functions)
+    regex = re.compile(re.escape('unload'))
+
+    time_start = time.perf_counter()
+    nesteds_start, _ = CppBaseMethods.determine_scopes(file_content)
+    scopes_time = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    traces = CppBaseMethods.nesting_mode_search(regex, file_content, skip_kinds=0)
+    nesting_mode_time = time.perf_counter() - time_start
+
+    return {'lines': file_content.count('\n'), 'scopes': len(nesteds_start), 'matches': len(traces),
+            'determine_scopes': scopes_time, 'nesting_mode_search': nesting_mode_time}
+
+
+def bench_jobs(paths: List[str], text: str = 'unload',
+               jobs_list: Sequence[int] = (1, 2, 4, 8, 16)) -> Dict[int, float]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, filename) for filename in filenames)
+        else:
+            files.append(path)
+    options = SearchOptions(mode='nesting', regex=re.compile(re.escape(text)),
+                            regex_for_single_line_skip=None, regex_for_multi_line_skip=None,
+                            skip_kinds=CppBaseMethods.skip_kinds(), prefilter=None, search_binary=False,
+                            cache=None, output_format='text', snippet=True, stream_size=0, changed_lines=None,
+                            git_revision=None, verbose=False)
+    result = {}
+    for jobs in jobs_list:
+        time_start = time.perf_counter()
+        for _ in search_files(files, options, jobs=jobs):
+            pass
+        result[jobs] = time.perf_counter() - time_start
+    return result
+
+
+def bench_stages(files: List[str], text: str = 'unload', repeat: int = 3) -> Dict[str, float]:
+    # total seconds of every stage of the search over the files, each stage fed with the output of the
+    # previous ones (best of `repeat`)
+    regex = re.compile(re.escape(text))
+    contents = [read_file(file)['file_content'] for file in files]
+    spans = [CppBaseMethods.tokenize(file_content) for file_content in contents]
+    masked = [CppBaseMethods.mask(file_content, file_spans, int(TokenKind.ALL))
+              for file_content, file_spans in zip(contents, spans)]
+    scopes = [CppBaseMethods.determine_scopes(file_content) for file_content in masked]
+    matches = [[match.span(0) for match in regex.finditer(file_content)] for file_content in contents]
+    regex_for_single_line_skip = CppBaseMethods.generate_regex_for_single_line_skip(single_line_comments=True)
+    regex_for_multi_line_skip = CppBaseMethods.generate_regex_for_multi_line_skip(
+        multi_line_comments=True, preprocessor_directives=True, char_literals=True, string_literals=True)
+
+    def determine_occurrences():
+        for file_content, file_matches in zip(contents, matches):
+            line_index = LineIndex(file_content)
+            for abs_start, abs_end in file_matches:
+                BaseMethods.determine_occurrence(file_content, abs_start, abs_end, line_index)
+
+    def replace_with_spaces():
+        for file_content in contents:
+            file_content = CppBaseMethods.replace_with_spaces(file_content, regex_for_single_line_skip)
+            CppBaseMethods.replace_with_spaces(file_content, regex_for_multi_line_skip)
+
+    stages = {
+        'read_file': lambda: [read_file(file) for file in files],
+        'tokenize': lambda: [CppBaseMethods.tokenize(file_content) for file_content in contents],
+        'mask': lambda: [CppBaseMethods.mask(file_content, file_spans, int(TokenKind.ALL))
+                         for file_content, file_spans in zip(contents, spans)],
+        'replace_with_spaces': replace_with_spaces,
+        'determine_scopes': lambda: [CppBaseMethods.determine_scopes(file_content) for file_content in masked],
+        'determine_occurrence': determine_occurrences,
+        'simple_mode_search': lambda: [CppBaseMethods.simple_mode_search(regex, file_content, skip_kinds=0,
+                                                                         spans=file_spans)
+                                       for file_content, file_spans in zip(contents, spans)],
+        'nesting_mode_search': lambda: [CppBaseMethods.nesting_mode_search(regex, file_content, skip_kinds=0,
+                                                                           spans=file_spans, scopes=file_scopes)
+                                        for file_content, file_spans, file_scopes in zip(contents, spans, scopes)],
+    }
+    return {stage: best_time(function, repeat) for stage, function in stages.items()}
+
+
+def bench_modes(files: List[str], text: str = 'unload', repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    # end-to-end `search_files` over the files for every mode, lexer and combination of the ignore flags
+    # (`-ic`, `-id`, `-icsl`, `none` for no flag); `lines` is the number of printed lines, a cheap check that
+    # the results did not change
+    result = {}
+    regex = re.compile(re.escape(text))
+    for mode in ('simple', 'nesting'):
+        for lexer in ('single-pass', 'regex'):
+            for comments, directives, literals in itertools.product((False, True), repeat=3):
+                if lexer == 'regex':
+                    skip_kinds = None
+                    regex_for_single_line_skip = CppBaseMethods.generate_regex_for_single_line_skip(
+                        single_line_comments=comments)
+                    regex_for_multi_line_skip = CppBaseMethods.generate_regex_for_multi_line_skip(
+                        multi_line_comments=comments, preprocessor_directives=directives,
+                        char_literals=literals, string_literals=literals)
+                else:
+                    skip_kinds = CppBaseMethods.skip_kinds(comments=comments, directives=directives,
+                                                           char_str_literals=literals)
+                    regex_for_single_line_skip = regex_for_multi_line_skip = None
+                options = SearchOptions(mode=mode, regex=regex, regex_for_single_line_skip=regex_for_single_line_skip,
+                                        regex_for_multi_line_skip=regex_for_multi_line_skip,
+                                        skip_kinds=skip_kinds, prefilter=None, search_binary=False, cache=None,
+                                        output_format='text', snippet=True, stream_size=0, changed_lines=None,
+                                        git_revision=None, verbose=False)
+                lines = 0
+
+                def run():
+                    nonlocal lines
+                    lines = sum(output.count('\n') for output, _ in search_files(files, options))
+
+                seconds = best_time(run, repeat)
+                flags = '+'.join(flag for flag, on in (('ic', comments), ('id', directives), ('icsl', literals))
+                                 if on) or 'none'
+                result[f"{mode}/{lexer}/{flags}"] = {'seconds': seconds, 'lines': lines}
+    return result
+
+
+def environment() -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit or None, 'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any]):
+    # prints the ratio of every timing to the same timing of the baseline results
+    print(f"compared with {baseline['environment'].get('commit') or '-'} (ratio > 1 is slower):")
+    for section in ('line_index', 'nesting', 'stages'):
+        for stage, seconds in result.get(section, {}).items():
+            old = baseline.get(section, {}).get(stage)
+            if isinstance(seconds, float) and old:
+                print(f"    {section + '/' + stage + ':':<36}{seconds / old:.2f}x")
+    for combination, entry in result.get('modes', {}).items():
+        old = baseline.get('modes', {}).get(combination)
+        if old and old['seconds']:
+            changed = '' if old['lines'] == entry['lines'] else f" (lines {old['lines']} -> {entry['lines']})"
+            print(f"    {combination + ':':<36}{entry['seconds'] / old['seconds']:.2f}x{changed}")
+
+
+# ========================================== MAIN ==========================================
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmark', description="C++ code searcher benchmarks")
+    parser.add_argument('--lines', type=int, default=50000, help='lines in the generated file')
+    parser.add_argument('--matches', type=int, default=10000, help='matches in the generated file')
+    parser.add_argument('--functions', type=int, default=2000, help='functions in the generated namespace')
+    parser.add_argument('--jobs-paths', type=str, default=[], nargs='+',
+                        help='dirs/files to measure `--jobs` scaling on (skipped if not given)')
+    parser.add_argument('--benchmarks', type=str, default=['line_index', 'nesting', 'corpus'], nargs='+',
+                        choices=['line_index', 'nesting', 'corpus'], help='benchmarks to run (default: all)')
+    parser.add_argument('--corpus-dir', type=str, default='',
+                        help='dir to generate the corpus in (default: a temporary dir)')
+    parser.add_argument('--files', type=int, default=200, help='generated C++ files in the corpus')
+    parser.add_argument('--file-functions', type=int, default=20, help='functions per generated file')
+    parser.add_argument('--depth', type=int, default=4, help='max nesting depth of the generated functions')
+    parser.add_argument('--comment-density', type=float, default=0.2, help='share of statements with a comment')
+    parser.add_argument('--literal-density', type=float, default=0.2, help='share of statements with literals')
+    parser.add_argument('--match-density', type=float, default=0.05, help='share of statements with a match')
+    parser.add_argument('--huge-namespace', type=int, default=2000,
+                        help='functions in the one huge namespace file, 0 - no such file')
+    parser.add_argument('--raw-strings', type=int, default=50,
+                        help='long raw strings in the raw strings file, 0 - no such file')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the corpus generator')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every corpus timing, the best is kept')
+    parser.add_argument('--output', type=str, default='', help='write the results as JSON to this file')
+    parser.add_argument('--compare', type=str, default='', help='JSON results of an earlier run to compare with')
+    args = parser.parse_args()
+    results = {'environment': environment()}
+
+    if 'line_index' in args.benchmarks:
+        result = results['line_index'] = bench_line_index(args.lines, args.matches)
+        print(f"line index: {result['lines']} lines, {result['matches']} matches")
+        print(f"    rescan:             {result['rescan']:.3f} seconds")
+        print(f"    line index:         {result['line_index']:.3f} seconds")
+        print(f"    simple_mode_search: {result['simple_mode_search']:.3f} seconds")
+
+    if 'nesting' in args.benchmarks:
+        result = results['nesting'] = bench_nesting(args.functions)
+        print(f"nesting: {result['lines']} lines, {result['scopes']} scopes, {result['matches']} matches")
+        print(f"    determine_scopes:    {result['determine_scopes']:.3f} seconds")
+        print(f"    nesting_mode_search: {result['nesting_mode_search']:.3f} seconds")
+
+    if 'corpus' in args.benchmarks:
+        corpus_options = CorpusOptions(files=args.files, functions=args.file_functions, depth=args.depth,
+                                       comment_density=args.comment_density,
+                                       literal_density=args.literal_density, match_density=args.match_density,
+                                       huge_namespace=args.huge_namespace, raw_strings=args.raw_strings,
+                                       seed=args.seed)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            files = generate_corpus(args.corpus_dir or temp_dir, corpus_options)
+            size = sum(os.path.getsize(file) for file in files)
+            results['corpus'] = dict(corpus_options, bytes=size)
+            print(f"corpus: {len(files)} files, {size / (1 << 20):.1f} MiB")
+            stages = results['stages'] = bench_stages(files, repeat=args.repeat)
+            for stage, seconds in stages.items():
+                print(f"    {stage + ':':<36}{seconds:.3f} seconds")
+            modes = results['modes'] = bench_modes(files, repeat=args.repeat)
+            for combination, entry in modes.items():
+                print(f"    {combination + ':':<36}{entry['seconds']:.3f} seconds, {entry['lines']} lines")
+
+    if args.jobs_paths:
+        print(f"jobs: {os.cpu_count()} CPUs")
+        results['jobs'] = bench_jobs(args.jobs_paths)
+        for jobs, seconds in results['jobs'].items():
+            print(f"    {jobs:>2} jobs: {seconds:.3f} seconds")
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            compare(results, json.load(fp))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,32 @@
+import re
+
+import pytest
+
+from app import search
+
+
+@pytest.fixture
+def tree(tmp_path):
+    (tmp_path / 'a.cpp').write_text('namespace n {\nvoid f() {\n  unload();\n}\n}\n// unload\n')
+    (tmp_path / 'b.h').write_text('void unload();\n')
+    return tmp_path
+
+
+def test_search_nesting(tree):
+    matches = list(search([str(tree / 'a.cpp')], text='unload', mode='nesting', ignore_comments=True))
+    assert len(matches) == 1
+    match = matches[0]
+    assert (match.line_start, match.column_start, match.text) == (3, 3, 'unload')
+    assert [scope.header for scope in match.scopes] == ['namespace n {', 'void f() {']
+
+
+def test_search_stops_early(tree):
+    assert len(list(search([str(tree)], regex=r'unload\(', max_results=1))) == 1
+    assert len(list(search([str(tree)], text='unload', first_match_per_file=True))) == 2
+
+
+@pytest.mark.parametrize('kwargs, error', [({}, ValueError), ({'text': 'x', 'mode': 'nested'}, ValueError),
+                                           ({'regex': '('}, re.error)])
+def test_search_checks_arguments_when_called(tree, kwargs, error):
+    with pytest.raises(error):
+        search([str(tree)], **kwargs)
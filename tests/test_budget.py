@@ -0,0 +1,68 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+from app import SearchOptions, search_files, search_files_budgeted
+
+app_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+catastrophic = r'(a+)+b'
+
+
+def options() -> SearchOptions:
+    return SearchOptions(mode='simple', regex=re.compile(catastrophic), regex_for_single_line_skip=None,
+                         regex_for_multi_line_skip=None, skip_kinds=None, prefilter=None, search_binary=False,
+                         cache=None, output_format='text', snippet=True, stream_size=0, changed_lines=None,
+                         git_revision=None, verbose=True)
+
+
+@pytest.fixture
+def files(tmp_path):
+    # the regex takes minutes on `slow` files (which pass the prefilter), the others have matches or no `a` runs
+    files = []
+    for i, kind in enumerate(['match', 'slow', 'plain', 'match', 'slow', 'match', 'plain', 'match']):
+        text = {'match': 'x = aab;\n', 'slow': 'b;\n' + 'a' * 40 + ';\n', 'plain': 'int x;\n'}[kind]
+        (tmp_path / f'{i}_{kind}.cpp').write_text(text)
+        files.append(str(tmp_path / f'{i}_{kind}.cpp'))
+    return files
+
+
+def is_slow(file: str) -> bool:
+    return os.path.basename(file).endswith('_slow.cpp')
+
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_slow_files_are_killed_and_order_is_kept(files, jobs):
+    fast_files = [file for file in files if not is_slow(file)]
+    expected = dict(zip(fast_files, search_files(fast_files, options())))
+    skipped = []
+    results = list(search_files_budgeted(files, options(), jobs=jobs, file_budget=0.5, skipped=skipped))
+    reason = 'exceeded the file time budget of 0.5 seconds'
+    assert results == [expected[file] if file in expected else ('', f'File {file} skipped: {reason}\n')
+                       for file in files]
+    assert sum(bool(output) for output, _ in results) == 4
+    assert skipped == [(file, reason) for file in files if is_slow(file)]
+
+
+def test_query_budget_abandons_the_rest(files):
+    skipped = []
+    results = list(search_files_budgeted(files, options(), query_budget=1.0, skipped=skipped))
+    reason = 'in progress when the query time budget of 1.0 seconds was exhausted'
+    expected = list(search_files(files[:1], options()))
+    assert results == expected + [('', f'File {files[1]} skipped: {reason}\n'),
+                                  ('', 'The query time budget of 1.0 seconds was exhausted, '
+                                       'the remaining files are not searched\n')]
+    assert skipped == [(files[1], reason)]
+
+
+def test_skipped_files_are_reported_after_the_output(files):
+    result = subprocess.run([sys.executable, app_path, '-p', *files, '-r', catastrophic, '-fb', '0.5', '-j', '2'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert result.returncode == 0
+    assert [line.split(':')[0] for line in result.stdout.decode().splitlines() if not line.startswith(' ')
+            and line] == [file for file in files if file.endswith('_match.cpp')]
+    errors = result.stderr.decode()
+    reason = 'exceeded the file time budget of 0.5 seconds'
+    assert errors.endswith(f'Files skipped by the time budgets: 2\n  {files[1]}: {reason}\n  {files[4]}: {reason}\n')
@@ -0,0 +1,72 @@
+import os
+import re
+
+from app import AnalysisCache, CppBaseMethods, SearchOptions, read_file, search_file
+
+
+def options(cache: AnalysisCache, mode: str = 'simple', skip_kinds: int = 0) -> SearchOptions:
+    return SearchOptions(mode=mode, regex=re.compile('unload'), regex_for_single_line_skip=None,
+                         regex_for_multi_line_skip=None, skip_kinds=skip_kinds, prefilter=None, search_binary=False,
+                         cache=cache, output_format='text', snippet=True, stream_size=0, changed_lines=None,
+                         git_revision=None, verbose=True)
+
+
+def cache_entries(cache_dir) -> int:
+    return sum(len(filenames) for _, _, filenames in os.walk(cache_dir))
+
+
+def test_store_and_load_round_trip(tmp_path):
+    cache = AnalysisCache(str(tmp_path / 'cache'), 1 << 20)
+    key = (10, 20, b'h' * 16)
+    spans = [(0, 5, 1), (7, 9, 8)]
+    scopes = ([1, 3], [9, 4])
+    cache.store('a.cpp', key, 'téxt', spans, scopes)
+    assert cache.load('a.cpp', key) == ('téxt', spans, scopes)
+    assert cache.load('a.cpp', (10, 21, b'h' * 16)) is None
+    cache.store('b.cpp', key, None, [], None)
+    assert cache.load('b.cpp', key) == (None, [], None)
+
+
+def test_simple_search_without_skipping_stores_entries(tmp_path):
+    source = tmp_path / 'a.cpp'
+    source.write_text('// unload\nvoid unloadﬁ() {}\n', encoding='utf-8')
+    cache_dir = tmp_path / 'cache'
+    cache = AnalysisCache(str(cache_dir), 1 << 20)
+    expected = search_file(str(source), options(None))
+    assert search_file(str(source), options(cache)) == expected
+    assert cache_entries(cache_dir) == 1
+
+    analysis = read_file(str(source), cache=cache)
+    assert analysis['spans'] == CppBaseMethods.tokenize(analysis['file_content'])
+    assert 'unloadfi' in analysis['file_content']
+    assert search_file(str(source), options(cache)) == expected
+    assert search_file(str(source), options(cache, 'nesting', CppBaseMethods.skip_kinds(comments=True))) == \
+        search_file(str(source), options(None, 'nesting', CppBaseMethods.skip_kinds(comments=True)))
+
+
+def test_truncated_or_corrupt_entries_are_misses(tmp_path):
+    cache = AnalysisCache(str(tmp_path / 'cache'), 1 << 20)
+    key = (10, 20, b'h' * 16)
+    cache.store('a.cpp', key, 'téxt', [(0, 5, 1), (7, 9, 8)], ([1], [9]))
+    path = cache.entry_path('a.cpp')
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    for corrupt in (data[:-1], data[:-5], data[:AnalysisCache.header.size + 2], data + b'\0',
+                    data[:-2] + b'\xff\xfe'):
+        with open(path, 'wb') as fp:
+            fp.write(corrupt)
+        assert cache.load('a.cpp', key) is None
+
+
+def test_search_with_truncated_entry(tmp_path):
+    source = tmp_path / 'a.cpp'
+    source.write_text('void f() {\n  unloadﬁ();\n}\n', encoding='utf-8')
+    cache = AnalysisCache(str(tmp_path / 'cache'), 1 << 20)
+    expected = search_file(str(source), options(None, 'nesting', CppBaseMethods.skip_kinds(comments=True)))
+    assert search_file(str(source), options(cache, 'nesting', CppBaseMethods.skip_kinds(comments=True))) == expected
+    path = cache.entry_path(str(source))
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    with open(path, 'wb') as fp:
+        fp.write(data[:-3])
+    assert search_file(str(source), options(cache, 'nesting', CppBaseMethods.skip_kinds(comments=True))) == expected
@@ -0,0 +1,35 @@
+import os
+
+import pytest
+
+from app import discover_files
+
+
+@pytest.fixture
+def tree(tmp_path, monkeypatch):
+    for name in ['a.cpp', 'src/b.cpp', 'src/b_test.cpp', 'src/sub/c.h', 'build/d.cpp', 'empty.cpp']:
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('' if name == 'empty.cpp' else 'x\n')
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def relative(files, root):
+    return sorted(os.path.relpath(file, root).replace(os.sep, '/') for file in files)
+
+
+@pytest.mark.parametrize('root', ['.', './', 'src/..', None])
+def test_dir_globs_are_relative_to_the_searched_dir(tree, root):
+    root = str(tree) if root is None else root
+    assert relative(discover_files([root], include=['src/*']), root) == ['src/b.cpp', 'src/b_test.cpp', 'src/sub/c.h']
+    assert relative(discover_files([root], include=['src/*.cpp'], exclude=['*_test.cpp']), root) == ['src/b.cpp']
+    assert relative(discover_files([root], exclude=['build', 'src/sub']), root) == \
+           ['a.cpp', 'src/b.cpp', 'src/b_test.cpp']
+    assert relative(discover_files(['src'], include=['sub/*']), 'src') == ['sub/c.h']
+
+
+def test_filters(tree):
+    assert relative(discover_files(['.'], extensions=['h']), '.') == ['src/sub/c.h']
+    assert relative(discover_files(['.', 'a.cpp'], cpp_only=True, exclude=['src']), '.') == \
+           ['a.cpp', 'a.cpp', 'build/d.cpp']
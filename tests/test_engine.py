@@ -0,0 +1,42 @@
+import pickle
+import re
+
+import pytest
+
+from app import LinearRegex, compile_regex
+
+
+@pytest.mark.parametrize('pattern, flags, needs_re', [
+    (r'std::\w+', 0, False),
+    (r'(?:x|y)+[a-z]{2}', re.I, False),
+    (r'(a)\1', 0, True),
+    (r'x|(?<=a)b', 0, True),
+    (r'[^a]+(?=b)', 0, True),
+    (r'(?>a+)', 0, True),
+    (r'a++', 0, True),
+    (r'(a)(?(1)b|c)', 0, True),
+    (r'a\Z', re.M, True),
+    (r'foo;$', 0, True),
+    (r'foo;$', re.M, False),
+    (r'(?m)foo;$', 0, False),
+    (r'x', re.A, True),
+    (r'(?a)x', 0, True),
+    (r'x', re.U, True),
+])
+def test_needs_re(pattern, flags, needs_re):
+    assert LinearRegex.needs_re(pattern, flags) is needs_re
+
+
+def test_linear_regex_matches_like_re():
+    pytest.importorskip('re2')
+    text = 'int a;\nfoo;\nstd::vector<int> v; foo;\n'
+    for pattern, flags in [(r'std::\w+', 0), (r'foo;$', re.M), (r'FOO', re.I), (r'a.\n', re.S)]:
+        regex = compile_regex(pattern, flags, 're2')
+        assert isinstance(regex, LinearRegex)
+        assert [m.span() for m in regex.finditer(text)] == [m.span() for m in re.finditer(pattern, text, flags)]
+        assert [m.span() for m in pickle.loads(pickle.dumps(regex)).finditer(text, 5)] == \
+            [m.span() for m in re.compile(pattern, flags).finditer(text, 5)]
+
+
+def test_unsupported_patterns_fall_back_to_re():
+    assert isinstance(compile_regex(r'foo;$', 0, 're2'), re.Pattern)
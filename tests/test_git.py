@@ -0,0 +1,152 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from app import CppBaseMethods, discover_changed_files, git_diff, git_range_revision, git_show
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason='git is not installed')
+
+app_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+def git(repo, *args):
+    subprocess.run(['git', '-C', str(repo), *args], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def repo(tmp_path):
+    repo = tmp_path / 'repo'
+    repo.mkdir()
+    git(repo, 'init', '-q')
+    git(repo, 'config', 'user.email', 'test@example.com')
+    git(repo, 'config', 'user.name', 'test')
+    return repo
+
+
+def commit_files(repo, files):
+    for name, text in files.items():
+        path = repo / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding='utf-8')
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-q', '-m', 'commit')
+
+
+def real(repo, name):
+    return os.path.realpath(os.path.join(str(repo), name))
+
+
+def test_file_names(repo):
+    names = ['plain.cpp', 'with space.cpp', 'quote".cpp', 'back\\slash.cpp', 'ünï.cpp', 'dir/tab\tname.cpp']
+    if sys.platform == 'win32':
+        names = names[:2]
+    commit_files(repo, {name: 'a\nb\nc\n' for name in names})
+    commit_files(repo, {name: 'a\nB\nc\n' for name in names})
+    assert git_diff('HEAD~1..HEAD', [str(repo)]) == {real(repo, name): [(1, 1)] for name in names}
+
+
+def test_hunks(repo):
+    commit_files(repo, {'a.cpp': ''.join(f'{i}\n' for i in range(10)), 'gone.cpp': 'x\n',
+                        'cut.cpp': 'a\nb\nc\n'})
+    (repo / 'a.cpp').write_text('++x\n0\n1\n2\n3\n4\n5\n6\n7\nnew\nnew\n9\n')
+    (repo / 'cut.cpp').write_text('a\nc\n')
+    (repo / 'gone.cpp').unlink()
+    diff = git_diff('HEAD', [str(repo)])
+    assert diff == {real(repo, 'a.cpp'): [(0, 0), (9, 10)]}
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-q', '-m', 'commit')
+    assert git_diff('HEAD~1..HEAD', [str(repo / 'a.cpp')]) == diff
+
+
+def test_git_diff_of_several_repositories(tmp_path):
+    repos = [tmp_path / 'one', tmp_path / 'two']
+    for repo in repos:
+        repo.mkdir()
+        git(repo, 'init', '-q')
+        git(repo, 'config', 'user.email', 'test@example.com')
+        git(repo, 'config', 'user.name', 'test')
+        commit_files(repo, {'a.cpp': 'a\n'})
+        (repo / 'a.cpp').write_text('b\n')
+    assert git_diff('HEAD', [str(repos[0]), str(repos[1] / 'a.cpp'), str(repos[0] / 'a.cpp')]) == \
+           {real(repos[0], 'a.cpp'): [(0, 0)], real(repos[1], 'a.cpp'): [(0, 0)]}
+
+
+@pytest.mark.parametrize('revision_range, revision', [('HEAD', None), ('main', None), ('A..B', 'B'),
+                                                      ('A...B', 'B'), ('A..', 'HEAD'), ('A...', 'HEAD'),
+                                                      ('B^!', 'B'), ('origin/main...HEAD', 'HEAD')])
+def test_git_range_revision(revision_range, revision):
+    assert git_range_revision(revision_range) == revision
+
+
+def test_git_show(repo):
+    commit_files(repo, {'sub/a.cpp': 'old\n'})
+    (repo / 'sub' / 'a.cpp').write_text('new\n')
+    assert git_show('HEAD', str(repo / 'sub' / 'a.cpp')) == b'old\n'
+
+
+def test_git_diff_fails_outside_repo(tmp_path):
+    with pytest.raises(OSError):
+        git_diff('HEAD', [str(tmp_path)])
+
+
+@pytest.mark.parametrize('first_line, last_line, expected', [(0, 0, False), (1, 2, True), (3, 4, False),
+                                                             (4, 9, True), (7, 7, True), (9, 20, False),
+                                                             (0, 20, True)])
+def test_intersects(first_line, last_line, expected):
+    assert CppBaseMethods.intersects([(2, 2), (5, 8)], first_line, last_line) == expected
+
+
+def test_discover_changed_files(repo, monkeypatch):
+    names = ['a.cpp', 'b.h', 'c.txt', 'sub/d.cpp', 'skip/e.cpp']
+    commit_files(repo, {name: 'x\n' for name in names})
+    changed = [real(repo, name) for name in names[:-1]] + [real(repo, 'skip/e.cpp')]
+    monkeypatch.chdir(repo)
+    assert sorted(discover_changed_files(['.'], changed)) == sorted(os.path.join('.', *name.split('/'))
+                                                                       for name in names)
+    assert list(discover_changed_files(['./a.cpp', 'c.txt'], changed[1:])) == ['c.txt']
+    assert sorted(discover_changed_files(['.'], changed, cpp_only=True, exclude=['skip'])) == \
+           [os.path.join('.', 'a.cpp'), os.path.join('.', 'b.h'), os.path.join('.', 'sub', 'd.cpp')]
+    assert sorted(discover_changed_files([str(repo)], changed, extensions=['h', 'txt'])) == \
+           [str(repo / 'b.h'), str(repo / 'c.txt')]
+    assert list(discover_changed_files(['sub'], changed, include=['*.cpp'])) == [os.path.join('sub', 'd.cpp')]
+    assert list(discover_changed_files(['.'], changed, include=['sub/*'])) == [os.path.join('.', 'sub', 'd.cpp')]
+    assert list(discover_changed_files([str(repo)], changed, include=['sub/*'])) == [str(repo / 'sub' / 'd.cpp')]
+    assert sorted(discover_changed_files(['.'], changed, exclude=['sub/*', 'skip', 'c.*'])) == \
+           [os.path.join('.', 'a.cpp'), os.path.join('.', 'b.h')]
+    (repo / 'a.cpp').unlink()
+    (repo / 'sub' / 'd.cpp').unlink()
+    assert list(discover_changed_files(['a.cpp', 'sub'], changed)) == []
+    assert list(discover_changed_files(['a.cpp', 'sub'], changed, in_working_tree=False)) == \
+           ['a.cpp', os.path.join('sub', 'd.cpp')]
+
+
+@pytest.mark.parametrize('mode', ['simple', 'nesting'])
+def test_search_changed_lines(repo, mode):
+    source = 'namespace n {\nvoid f() {\n  unload();\n}\nvoid g() {\n  unload();\n}\n}\n'
+    commit_files(repo, {'a.cpp': source, 'b.cpp': 'unload();\n'})
+    (repo / 'a.cpp').write_text(source[:source.rindex('unload();')] + 'unload(1);\n}\n}\n')
+    result = subprocess.run([sys.executable, app_path, '-m', mode, '-p', str(repo), '-t', 'unload', '-gr', 'HEAD',
+                             '-fo', 'jsonl'], stdout=subprocess.PIPE, check=True)
+    records = [json.loads(line) for line in result.stdout.decode().splitlines()]
+    assert [record['line'] for record in records] == [6]
+    assert records[0]['file'] == str(repo / 'a.cpp')
+    if mode == 'nesting':
+        assert [scope['text'] for scope in records[0]['scopes']] == ['namespace n {', 'void g() {']
+        assert (records[0]['scopes'][0]['line'], records[0]['scopes'][0]['end_line']) == (1, 8)
+
+
+@pytest.mark.parametrize('mode', ['simple', 'nesting'])
+def test_search_range_reads_last_revision(repo, mode):
+    commit_files(repo, {'a.cpp': 'void f() {\n}\n'})
+    commit_files(repo, {'a.cpp': 'void f() {\n  unload();\n}\n'})
+    (repo / 'a.cpp').write_text('unload();\n')
+    result = subprocess.run([sys.executable, app_path, '-m', mode, '-p', str(repo), '-t', 'unload',
+                             '-gr', 'HEAD~1..HEAD', '-fo', 'jsonl'], stdout=subprocess.PIPE, check=True)
+    records = [json.loads(line) for line in result.stdout.decode().splitlines()]
+    assert [(record['line'], record['text']) for record in records] == [(2, '  unload();')]
+    if mode == 'nesting':
+        assert [scope['text'] for scope in records[0]['scopes']] == ['void f() {']
@@ -0,0 +1,86 @@
+import os
+import random
+import re
+
+import pytest
+
+from app import PatternSet, TrigramIndex, decode_varint, encode_varint
+
+
+def test_varint_round_trip():
+    values = [0, 1, 127, 128, 300, 1 << 32, (1 << 63) + 5]
+    data = bytearray()
+    for value in values:
+        encode_varint(value, data)
+    pos = 0
+    for value in values:
+        decoded, pos = decode_varint(data, pos)
+        assert decoded == value
+    assert pos == len(data)
+
+
+@pytest.fixture
+def tree(tmp_path):
+    rnd = random.Random(0)
+    words = ['unload', 'load', 'item', 'second', 'vector', 'Widget', 'std::map', 'x']
+    files = []
+    for i in range(40):
+        path = tmp_path / f'f{i}.cpp'
+        path.write_text(' '.join(rnd.choice(words) for _ in range(rnd.randint(0, 20))) + '\n')
+        files.append(str(path))
+    (tmp_path / 'u.cpp').write_text('void ﬁle_unload();\n', encoding='utf-8')
+    (tmp_path / 'b.bin').write_bytes(b'\0unload')
+    files += [str(tmp_path / 'u.cpp'), str(tmp_path / 'b.bin')]
+    return files
+
+
+def test_write_and_load(tmp_path, tree):
+    index_path = str(tmp_path / 'idx')
+    assert TrigramIndex.update(index_path, tree) == (len(tree), len(tree))
+    index = TrigramIndex.load(index_path)
+    assert [file[0] for file in index.files] == [os.path.abspath(file) for file in tree]
+    file_postings = index.file_postings()
+    for file_id, (path, size, mtime_ns, flags) in enumerate(index.files):
+        with open(path, 'rb') as fp:
+            data = fp.read()
+        if flags & TrigramIndex.always_search_flag:
+            assert not file_postings.get(file_id)
+        else:
+            assert set(file_postings.get(file_id, ())) == TrigramIndex.file_trigrams(data)
+    assert TrigramIndex.update(index_path, tree) == (len(tree), 0)
+
+
+@pytest.mark.parametrize('pattern', [r'unload', r'item\.second', r'std::map', r'WIDGET', r'(?i)vector.*widget'])
+def test_file_filter_keeps_every_matching_file(tmp_path, tree, pattern):
+    index_path = str(tmp_path / 'idx')
+    TrigramIndex.update(index_path, tree)
+    regex = re.compile(pattern, re.I if pattern.isupper() else 0)
+    file_filter = TrigramIndex.load(index_path).file_filter(regex)
+    assert file_filter is not None
+    for file in tree:
+        with open(file, 'rb') as fp:
+            data = fp.read()
+        if regex.search(data.decode('utf-8', 'replace')):
+            assert file_filter(file), file
+    assert sum(map(file_filter, tree)) < len(tree)
+
+
+def test_file_filter_without_literals_and_of_pattern_sets(tmp_path, tree):
+    index_path = str(tmp_path / 'idx')
+    TrigramIndex.update(index_path, tree)
+    index = TrigramIndex.load(index_path)
+    assert index.file_filter(re.compile(r'\w+')) is None
+    patterns = PatternSet([('1', re.compile('unload')), ('2', re.compile('vector'))])
+    file_filter = index.file_filter(patterns)
+    unload, vector = index.file_filter(re.compile('unload')), index.file_filter(re.compile('vector'))
+    assert all(file_filter(file) == (unload(file) or vector(file)) for file in tree)
+
+
+def test_changed_files_are_searched(tmp_path, tree):
+    index_path = str(tmp_path / 'idx')
+    TrigramIndex.update(index_path, tree)
+    absent = tree[0]
+    with open(absent, 'w') as fp:
+        fp.write('zzqq\n')
+    file_filter = TrigramIndex.load(index_path).file_filter(re.compile('zzqq'))
+    assert file_filter(absent)
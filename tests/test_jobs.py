@@ -0,0 +1,50 @@
+import multiprocessing
+import os
+import re
+
+import pytest
+
+import app
+from app import SearchOptions, search_files
+
+
+def options() -> SearchOptions:
+    return SearchOptions(mode='simple', regex=re.compile('unload'), regex_for_single_line_skip=None,
+                         regex_for_multi_line_skip=None, skip_kinds=None, prefilter=None, search_binary=False,
+                         cache=None, output_format='jsonl', snippet=True, stream_size=0, changed_lines=None,
+                         git_revision=None, verbose=True)
+
+
+@pytest.fixture
+def files(tmp_path):
+    files = []
+    for i in range(30):
+        (tmp_path / f'{i}.cpp').write_text('unload();\n' * (i % 4))
+        files.append(str(tmp_path / f'{i}.cpp'))
+    return files
+
+
+def test_results_keep_file_order(files):
+    expected = list(search_files(files, options()))
+    assert [output.count('\n') for output, _ in expected] == [i % 4 for i in range(30)]
+    assert list(search_files(files, options(), jobs=3)) == expected
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='workers must inherit the patched search')
+def test_stopped_process_is_reported(files, monkeypatch):
+    expected = list(search_files(files, options()))
+    search_file = app.search_file
+
+    def crashing_search_file(file, options):
+        if file == files[5]:
+            os._exit(1)
+        return search_file(file, options)
+
+    monkeypatch.setattr(app, 'search_file', crashing_search_file)
+    results = list(search_files(files, options(), jobs=2))
+    assert len(results) == len(files)
+    assert results[5] == ('', f'File {files[5]} skipped: the search process stopped\n')
+    for file, result, expected_result in zip(files, results, expected):
+        assert result in (expected_result, ('', f'File {file} skipped: the search process stopped\n'))
+    assert results[:5] == expected[:5]
+    assert results[-10:] == expected[-10:]
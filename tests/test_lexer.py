@@ -0,0 +1,92 @@
+import itertools
+import random
+import re
+
+import pytest
+
+from app import CppBaseMethods, TokenKind
+
+
+def reference_replace_with_spaces(file_content: str, regex: re.Pattern) -> str:
+    # `replace_with_spaces` as it was before the single-pass lexer: the file is rebuilt per match
+    for match in regex.finditer(file_content):
+        start, end = match.span(0)
+        mid_string = ''
+        for line in match.group(0).splitlines(True):
+            end = start + len(line)
+            b = (line[-1] == '\n')
+            mid_string += ' ' * (end - start - b) + '\n' * b
+            start = end + 1
+        start, end = match.span(0)
+        file_content = file_content[:start] + mid_string + file_content[end:]
+    return file_content
+
+
+def regex_mask(file_content: str, comments: bool, directives: bool, literals: bool) -> str:
+    # the masking of `--lexer regex`
+    file_content = CppBaseMethods.replace_with_spaces(
+        file_content, CppBaseMethods.generate_regex_for_single_line_skip(single_line_comments=comments))
+    return CppBaseMethods.replace_with_spaces(
+        file_content, CppBaseMethods.generate_regex_for_multi_line_skip(
+            multi_line_comments=comments, preprocessor_directives=directives,
+            char_literals=literals, string_literals=literals))
+
+
+def lexer_mask(file_content: str, comments: bool, directives: bool, literals: bool) -> str:
+    return CppBaseMethods.mask(file_content, CppBaseMethods.tokenize(file_content),
+                               CppBaseMethods.skip_kinds(comments=comments, directives=directives,
+                                                         char_str_literals=literals))
+
+
+# code the regexes mask correctly: no quotes in comments, no comment markers in literals or right after `*/`,
+# directives on their own lines
+plain_pieces = ['int a;', ' ', '\n', 'f(x);', '{', '}', 'x = y / z;', '// note\n', '/* block */ ', '/* two\nlines */ ',
+                '"text"', '"a\\"b"', "'c'", "'\\n'", '\n#include <v>\n', '\n#define X(a) \\\n  (a + 1)\n']
+
+
+def random_file(rnd: random.Random, pieces) -> str:
+    return ''.join(rnd.choice(pieces) for _ in range(rnd.randint(1, 200)))
+
+
+@pytest.mark.parametrize('comments, directives, literals', list(itertools.product((False, True), repeat=3)))
+def test_lexer_masks_like_regexes_on_plain_code(comments, directives, literals):
+    for seed in range(200):
+        text = random_file(random.Random(seed), plain_pieces)
+        assert lexer_mask(text, comments, directives, literals) == regex_mask(text, comments, directives, literals), \
+            seed
+
+
+def test_replace_with_spaces_is_unchanged():
+    pieces = plain_pieces + ["'\\\\'", "// it's\n", '/* "x */', 'R"(a)"', "1'000"]
+    for seed in range(300):
+        text = random_file(random.Random(seed), pieces)
+        for regex in (CppBaseMethods.regex_for_single_line_skip, CppBaseMethods.regex_for_multi_line_skip):
+            assert CppBaseMethods.replace_with_spaces(text, regex) == reference_replace_with_spaces(text, regex), seed
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("char c = '\\\\'; int x; // it's\n", 'char c =     ; int x;        \n'),
+    ("int n = 1'000'000; f('}');\n", "int n = 1'000'000; f(   );\n"),
+    ('auto s = R"xy(a ")" })xy"; g();\n', 'auto s = R               ; g();\n'),
+    ('x = u8R"(raw\n{ )"; y = LR"--(a)--";\n', 'x = u8R     \n    ; y = LR         ;\n'),
+    ('#define A(x) \\\n  { x }\nint y;\n', '              \n       \nint y;\n'),
+    ('  #  include <a.h> // c\nint z;\n', '                       \nint z;\n'),
+    ('/* "not a string */ s = "// not a comment"; \'"\';\n', '                    s =                   ;    ;\n'),
+    ('s = "esc \\" still"; t = "line\\\ncont";\n', 's =               ; t =       \n     ;\n'),
+    ('a = b / c; /* multi\nline */ d;\n', 'a = b / c;         \n        d;\n'),
+    ('int x; // c \\\n continued\nint y;\n', 'int x;       \n          \nint y;\n'),
+    ('"unterminated\nint q;\n', '             \nint q;\n'),
+])
+def test_lexer_edge_cases(text, expected):
+    assert CppBaseMethods.mask(text, CppBaseMethods.tokenize(text), int(TokenKind.ALL)) == expected
+
+
+def test_lexer_kinds_are_masked_separately():
+    text = '#define S "s" // c\nx = "str" + \'c\'; /* b */\n'
+    spans = CppBaseMethods.tokenize(text)
+    assert CppBaseMethods.mask(text, spans, int(TokenKind.COMMENT)) == \
+        '#define S "s"     \nx = "str" + \'c\';        \n'
+    assert CppBaseMethods.mask(text, spans, int(TokenKind.DIRECTIVE)) == \
+        '                  \nx = "str" + \'c\'; /* b */\n'
+    assert CppBaseMethods.mask(text, spans, int(TokenKind.STRING_LITERAL | TokenKind.CHAR_LITERAL)) == \
+        '#define S     // c\nx =       +    ; /* b */\n'
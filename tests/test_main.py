@@ -0,0 +1,28 @@
+import json
+import sys
+
+import pytest
+
+import app
+
+
+def test_records_written_before_an_interruption_are_kept(tmp_path, monkeypatch, capfd):
+    files = []
+    for i in range(3):
+        (tmp_path / f'{i}.cpp').write_text('unload();\n')
+        files.append(str(tmp_path / f'{i}.cpp'))
+    search_files = app.search_files
+
+    def interrupted(*args, **kwargs):
+        for i, result in enumerate(search_files(*args, **kwargs)):
+            if i == 2:
+                raise KeyboardInterrupt
+            yield result
+
+    monkeypatch.setattr(app, 'search_files', interrupted)
+    monkeypatch.setattr(sys, 'argv', ['app', '-p', *files, '-t', 'unload', '-fo', 'jsonl'])
+    with pytest.raises(KeyboardInterrupt) as excinfo:
+        app.main()
+    # `excinfo` keeps the frame of `main` alive, so nothing is flushed when it is collected
+    assert excinfo.traceback
+    assert [json.loads(line)['file'] for line in capfd.readouterr().out.splitlines()] == files[:2]
@@ -0,0 +1,37 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+app_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py')
+
+
+def run_app(*args):
+    return subprocess.run([sys.executable, app_path, *args], stdout=subprocess.PIPE, check=True).stdout.decode()
+
+
+@pytest.fixture
+def source(tmp_path):
+    (tmp_path / 'a.cpp').write_text('void f() {\n  unload();\n}\n')
+    return str(tmp_path / 'a.cpp')
+
+
+@pytest.mark.parametrize('lines, tag', [('NAME\tunload\n', 'NAME'), ('unload\n', '1')])
+def test_single_pattern_of_pattern_file_is_tagged(tmp_path, source, lines, tag):
+    (tmp_path / 'patterns.txt').write_text(lines)
+    pattern_file = str(tmp_path / 'patterns.txt')
+    assert [json.loads(line)['pattern'] for line in run_app('-p', source, '-pf', pattern_file, '-fo', 'jsonl')
+            .splitlines()] == [tag]
+    for mode in ('simple', 'nesting'):
+        assert f':2:3-' + ('2:9' if mode == 'simple' else '9') + f' [{tag}]\n' in \
+               run_app('-p', source, '-pf', pattern_file, '-m', mode)
+
+
+@pytest.mark.parametrize('args', [('-t', 'unload'), ('-r', 'unl.ad')])
+def test_single_text_or_regex_is_not_tagged(source, args):
+    assert 'pattern' not in json.loads(run_app('-p', source, *args, '-fo', 'jsonl'))
+    assert '[' not in run_app('-p', source, *args)
+    assert [json.loads(line)['pattern'] for line in run_app('-p', source, *args, 'void', '-fo', 'jsonl')
+            .splitlines()] == ['2', '1']
@@ -0,0 +1,112 @@
+import bisect
+import random
+import re
+
+from app import CppBaseMethods, ScopeStack, TokenKind
+
+
+def reference_scopes(clean_file_content: str):
+    # the scan `determine_scopes` replaced: from every flow control header until its braces balance
+    nesteds_start = []
+    nesteds_end = []
+    for match in CppBaseMethods.flow_control_regex.finditer(clean_file_content):
+        start, end = match.span(0)
+        round_brackets = square_brackets = curly_braces = 0
+        error = False
+        for pos, ch in enumerate(clean_file_content[start:], start):
+            if ch == '{':
+                curly_braces += 1
+            elif ch == '}':
+                curly_braces -= 1
+                if curly_braces == round_brackets == square_brackets == 0:
+                    end = pos + 1
+                    break
+                elif curly_braces < 0:
+                    error = True
+                    break
+            elif ch == '(':
+                round_brackets += 1
+            elif ch == ')':
+                round_brackets -= 1
+                if round_brackets < 0:
+                    error = True
+                    break
+            elif ch == '[':
+                square_brackets += 1
+            elif ch == ']':
+                square_brackets -= 1
+                if square_brackets < 0:
+                    error = True
+                    break
+            elif ch == ';' and curly_braces == round_brackets == square_brackets == 0:
+                end = pos + 1
+                break
+        else:
+            end = len(clean_file_content)
+        if not error:
+            nesteds_start.append(start)
+            nesteds_end.append(end)
+    return nesteds_start, nesteds_end
+
+
+def reference_traces(regex: re.Pattern, file_content: str):
+    # nesting traces as they were built before `ScopeStack`: every earlier scope is checked per match
+    nesteds_start, nesteds_end = reference_scopes(
+        CppBaseMethods.mask(file_content, CppBaseMethods.tokenize(file_content), int(TokenKind.ALL)))
+    traces = []
+    for match in regex.finditer(file_content):
+        abs_start, abs_end = match.span(0)
+        occ = CppBaseMethods.determine_occurrence(file_content, abs_start, abs_end)
+        trace = [(file_content[occ['abs_start_of_start_block']:occ['abs_end_of_end_block']],
+                  CppBaseMethods.trace_location(occ))]
+        last_block_index_start = occ['block_index_start']
+        for i in range(bisect.bisect_right(nesteds_start, abs_start) - 1, -1, -1):
+            if not nesteds_start[i] <= abs_start <= nesteds_end[i]:
+                continue
+            occ = CppBaseMethods.determine_occurrence(file_content, nesteds_start[i], nesteds_end[i])
+            block_index_start, block_index_end = occ['block_index_start'], occ['block_index_end']
+            if block_index_start == last_block_index_start:
+                continue
+            format_string = f"{1 + block_index_start}-{1 + block_index_end}" \
+                if block_index_start != block_index_end else f"{1 + block_index_start}"
+            trace.append((file_content[occ['abs_start_of_start_block']:occ['abs_end_of_start_block']],
+                          format_string))
+            last_block_index_start = block_index_start
+        traces.append(trace[::-1])
+    return traces
+
+
+# well-formed and malformed bracket soup with headers of every kind
+pieces = ['namespace n', 'class C', 'struct S', 'enum E', 'if (x)', 'else', 'else if (y)', 'for (i;j;k)', 'while (y)',
+          'do', 'switch (v)', 'try', 'catch (e)', 'f(a, b)', 'g()', '{', '{', '}', '}', '(', ')', '[', ']', ';', ';',
+          '\n', '\n', ' ', 'x', 'foo();', 'a[i] = {1, 2};', '// c {\n', '"}"']
+
+
+def random_file(seed: int) -> str:
+    rnd = random.Random(seed)
+    return ''.join(rnd.choice(pieces) for _ in range(rnd.randint(1, 300)))
+
+
+def test_determine_scopes_matches_brace_scan():
+    for seed in range(1000):
+        text = random_file(seed)
+        clean = CppBaseMethods.mask(text, CppBaseMethods.tokenize(text), int(TokenKind.ALL))
+        assert CppBaseMethods.determine_scopes(clean) == reference_scopes(clean), seed
+
+
+def test_nesting_traces_match_reference():
+    regex = re.compile(r'foo|x')
+    for seed in range(300):
+        text = random_file(seed)
+        assert CppBaseMethods.nesting_mode_search(regex, text, skip_kinds=0) == reference_traces(regex, text), seed
+
+
+def test_scope_stack_enclosing():
+    rnd = random.Random(0)
+    for _ in range(200):
+        starts = sorted(rnd.randrange(100) for _ in range(rnd.randint(0, 30)))
+        ends = [start + rnd.randrange(50) for start in starts]
+        stack = ScopeStack(starts, ends)
+        for position in sorted(rnd.randrange(150) for _ in range(40)):
+            expected = [i for i in range(len(starts)) if starts[i] <= position <= ends[i]]
+            assert sorted(stack.enclosing(position)) == expected
@@ -0,0 +1,34 @@
+import io
+import json
+
+import pytest
+
+from app import SearchServer
+
+
+@pytest.fixture
+def server(tmp_path):
+    (tmp_path / 'a.cpp').write_text('namespace n {\nvoid unload() {}\n}\n')
+    return SearchServer([str(tmp_path)], {}, memory_budget=1 << 20)
+
+
+def test_query_nesting(server):
+    response = json.loads(server.handle_line('{"id": 1, "mode": "nesting", "text": "unload"}'))
+    assert response['id'] == 1
+    assert 'namespace n {' in response['output'] and 'void unload() {}' in response['output']
+
+
+@pytest.mark.parametrize('line', ['{"text": 123}', '{"text": "x", "flags": 5}', '{"command": []}',
+                                  '{"regex": "("}', '[1]', 'not json'])
+def test_malformed_requests_get_errors(server, line):
+    assert 'error' in json.loads(server.handle_line(line))
+
+
+def test_server_keeps_running_after_malformed_requests(server):
+    stdin = io.StringIO('{"text": 123}\n{"text": "x", "flags": 5}\n{"id": 2, "text": "unload"}\n'
+                        '{"command": "shutdown"}\n{"id": 3, "text": "unload"}\n')
+    stdout = io.StringIO()
+    server.serve_stdio(stdin, stdout)
+    responses = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert [response.get('id') for response in responses] == [None, None, 2]
+    assert 'unload' in responses[2]['output']
@@ -0,0 +1,65 @@
+import io
+import random
+import re
+
+import pytest
+
+from app import CppBaseMethods, PatternSet, TokenKind, read_chunks
+
+# pieces of C++-like text: headers, brackets, tokens and line breaks, so random files exercise windows cut
+# inside headers, tokens and scopes
+pieces = ['namespace n', 'class C', 'if (x)', 'for (i;j;k)', 'while (y)', 'f(a, b)', '{', '}', ';', '\n', '\n', '\n',
+          '// c {', '/* c\n { */', '"s{"', "'}'", 'foo();', '#define X {\n', ' ', 'xxxxxxx', '(', ')', '[', ']',
+          'else', 'do', 'struct S', 'int a[2] = {1, 2};', 'R"(a{)"']
+regexes = [re.compile(r'foo|x+'), re.compile(r'\w+'), re.compile(r'a\s*b|;\n'),
+           PatternSet([('1', re.compile('foo')), ('2', re.compile(r'\(\w'))])]
+skip_kinds = [0, int(TokenKind.ALL), int(TokenKind.COMMENT), int(TokenKind.STRING_LITERAL | TokenKind.CHAR_LITERAL)]
+
+
+def chunks(text: str, size: int):
+    # pieces of about `size` chars that end with a line break (but the last), as `read_chunks` gives them
+    pos = 0
+    while pos < len(text):
+        cut = text.find('\n', pos + size - 1)
+        cut = len(text) if cut == -1 else cut + 1
+        yield text[pos:cut]
+        pos = cut
+
+
+def whole_file_search(regex, text: str, kinds: int, nesting: bool):
+    if nesting:
+        return CppBaseMethods.nesting_mode_search(regex, text, skip_kinds=kinds)
+    return CppBaseMethods.simple_mode_search(regex, text, skip_kinds=kinds)
+
+
+@pytest.mark.parametrize('nesting', [False, True])
+def test_stream_search_matches_whole_file_search(nesting):
+    for seed in range(400):
+        rnd = random.Random(seed)
+        text = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(1, 400)))
+        regex = rnd.choice(regexes)
+        kinds = rnd.choice(skip_kinds)
+        size = rnd.randint(1, 200)
+        assert CppBaseMethods.stream_search(regex, chunks(text, size), kinds, nesting) == \
+            whole_file_search(regex, text, kinds, nesting), (seed, size)
+
+
+def test_stream_search_header_without_bracket_in_window():
+    text = '// ' + 'x' * 4056 + '\nnamespace n\n// opening brace below\n{\n  foo();\n}\n'
+    regex = re.compile('foo')
+    expected = [[('namespace n', '2-6'), ('  foo();', '5:3-6')]]
+    assert CppBaseMethods.nesting_mode_search(regex, text, skip_kinds=0) == expected
+    assert CppBaseMethods.stream_search(regex, read_chunks(io.BytesIO(text.encode()), 4096), 0, True) == expected
+
+
+def test_stream_search_many_sibling_scopes():
+    text = 'void f() {\n' + '    if (x) { y(); }\n' * 3000 + '}\n'
+    regex = re.compile(r'y\(\)')
+    assert CppBaseMethods.stream_search(regex, chunks(text, 4096), 0, True) == \
+        CppBaseMethods.nesting_mode_search(regex, text, skip_kinds=0)
+
+
+def test_read_chunks_normalizes_line_breaks_and_unicode():
+    data = 'a\r\nb\rc\n\u00e9\n'.encode() * 1000
+    text = ''.join(read_chunks(io.BytesIO(data), 64))
+    assert text == 'a\nb\nc\ne\u0301\n' * 1000